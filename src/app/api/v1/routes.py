@@ -7,17 +7,21 @@ health checks, and model information.
 
 import logging
 import time
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import TypeAdapter
 from starlette.status import (
+    HTTP_400_BAD_REQUEST,
     HTTP_500_INTERNAL_SERVER_ERROR,
     HTTP_503_SERVICE_UNAVAILABLE,
+    HTTP_504_GATEWAY_TIMEOUT,
 )
 
-from ....lib.core.config import get_settings
-from ...schemas.request import GenerationRequest
+from ....inference.engine import Prompt
+from ...schemas.request import ChatRequest, GenerationRequest, SamplingParams
 from ...schemas.response import (
     ErrorResponse,
     GenerationResponse,
@@ -30,6 +34,19 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Pre-encoded server-sent event framing
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+_SSE_DONE = b"data: [DONE]\n\n"
+
+_generation_response_adapter = TypeAdapter(GenerationResponse)
+
+_STREAM_DEPRECATION = {
+    "Deprecation": "true",
+    "Warning": '299 - "stream=true on /generate is deprecated; '
+    'use /generate/stream"',
+}
+
 
 def get_inference_service_dep() -> InferenceService:
     """Dependency to get the inference service"""
@@ -37,14 +54,16 @@ def get_inference_service_dep() -> InferenceService:
 
 
 @router.get("/health", response_model=HealthResponse)
-async def health_check(service: InferenceService = Depends(get_inference_service_dep)):
+async def health_check(
+    request: Request, service: InferenceService = Depends(get_inference_service_dep)
+):
     """
     Health check endpoint.
 
     Returns the current status of the inference service and model.
     """
     try:
-        settings = get_settings()
+        settings = request.app.state.settings
 
         return HealthResponse(
             status="healthy" if service.is_ready else "loading",
@@ -60,40 +79,88 @@ async def health_check(service: InferenceService = Depends(get_inference_service
         )
 
 
-@router.post("/generate", response_model=GenerationResponse)
+def _ensure_ready(service: InferenceService):
+    """Raise 503 if the inference service cannot take requests yet"""
+    if not service.is_ready:
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Inference service is not ready. Please wait for model to load.",
+        )
+
+
+def _check_context(prompt_tokens: int, max_tokens: int, n_ctx: int):
+    """Raise 400 if the prompt plus max_tokens cannot fit in the context window"""
+    if prompt_tokens + max_tokens > n_ctx:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail=(
+                f"Prompt ({prompt_tokens} tokens) plus max_tokens "
+                f"({max_tokens}) exceeds the context size ({n_ctx})"
+            ),
+        )
+
+
+async def _ensure_fits_context(
+    service: InferenceService, request: GenerationRequest, n_ctx: int
+):
+    """Raise 400 if the prompt plus max_tokens cannot fit in the context window"""
+    prompt_tokens = await service.engine.tokenize_len(request.prompt)
+    _check_context(prompt_tokens, request.max_tokens, n_ctx)
+
+
+def _stream_response(
+    service: InferenceService,
+    request: SamplingParams,
+    headers: Optional[Dict[str, str]] = None,
+    prompt: Optional[Prompt] = None,
+) -> StreamingResponse:
+    """Build the server-sent events response for a streaming generation"""
+    return StreamingResponse(
+        _generate_stream(service, request, prompt),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            **(headers or {}),
+        },
+    )
+
+
+@router.post("/generate", responses={200: {"model": GenerationResponse}})
 async def generate_text(
     request: GenerationRequest,
+    http_request: Request,
     service: InferenceService = Depends(get_inference_service_dep),
-):
+) -> Response:
     """
     Generate text completion for a given prompt.
 
-    This endpoint supports both regular and streaming responses based on
-    the 'stream' parameter in the request.
+    Streaming clients should use /generate/stream. Setting 'stream' here is
+    deprecated but still honoured.
     """
-    if not service.is_ready:
-        raise HTTPException(
-            status_code=HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Inference service is not ready. Please wait for model to load.",
-        )
+    _ensure_ready(service)
+    settings = http_request.app.state.settings
+    await _ensure_fits_context(service, request, settings.n_ctx)
 
-    try:
-        if request.stream:
-            # Return streaming response
-            return StreamingResponse(
-                _generate_stream(service, request),
-                media_type="text/plain",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "Content-Type": "text/plain; charset=utf-8",
-                },
-            )
-        else:
-            # Return regular response
-            result = await service.generate(request)
-            return result
+    if request.stream:
+        return _stream_response(service, request, headers=_STREAM_DEPRECATION)
 
+    try:
+        # The engine already builds a dict in the GenerationResponse shape,
+        # so serialize it directly with orjson instead of re-validating it
+        # through a response model. Validation is kept in verbose mode only.
+        result = await service.generate(request)
+        if settings.verbose:
+            _generation_response_adapter.validate_python(result)
+        return ORJSONResponse(result)
+
+    except TimeoutError as e:
+        logger.warning(f"Generation deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Generation deadline exceeded: {str(e)}",
+        )
     except Exception as e:
         logger.error(f"Generation failed: {e}")
         raise HTTPException(
@@ -102,31 +169,75 @@ async def generate_text(
         )
 
 
-async def _generate_stream(service: InferenceService, request: GenerationRequest):
+@router.post("/generate/stream")
+async def generate_text_stream(
+    request: GenerationRequest,
+    http_request: Request,
+    service: InferenceService = Depends(get_inference_service_dep),
+) -> Response:
     """
-    Generate streaming response.
+    Stream a text completion for a given prompt as server-sent events.
 
-    This function handles server-sent events for streaming text generation.
+    The 'stream' parameter is ignored; this endpoint always streams.
+    """
+    _ensure_ready(service)
+    await _ensure_fits_context(service, request, http_request.app.state.settings.n_ctx)
+    return _stream_response(service, request)
+
+
+@router.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    http_request: Request,
+    service: InferenceService = Depends(get_inference_service_dep),
+) -> Response:
+    """
+    Stream the assistant's reply to a conversation as server-sent events.
+
+    Messages are rendered in the loaded model's prompt format. Clients resend
+    the whole conversation each turn; messages already seen in an earlier
+    turn are not tokenized again.
     """
+    _ensure_ready(service)
+    messages = [message.model_dump() for message in request.messages]
     try:
-        async for chunk in service.generate_stream(request):
-            # Format as server-sent event
-            chunk_text = chunk.get("choices", [{}])[0].get("text", "")
+        tokens: List[int] = await service.engine.chat_prompt_tokens(messages)
+    except Exception as e:
+        logger.error(f"Chat prompt preparation failed: {e}")
+        raise HTTPException(
+            status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Chat prompt preparation failed: {str(e)}",
+        )
+    _check_context(
+        len(tokens), request.max_tokens, http_request.app.state.settings.n_ctx
+    )
+    return _stream_response(service, request, prompt=tokens)
+
 
-            # Only yield non-empty chunks
-            if chunk_text:
-                yield f"data: {chunk_text}\n\n"
+async def _generate_stream(
+    service: InferenceService,
+    request: SamplingParams,
+    prompt: Optional[Prompt] = None,
+):
+    """
+    Generate streaming response.
 
-            # Check if generation is complete
-            finish_reason = chunk.get("choices", [{}])[0].get("finish_reason")
-            if finish_reason:
-                yield f"data: [DONE]\n\n"
-                break
+    This function handles server-sent events for streaming text generation.
+    It must stay an async generator: Starlette iterates sync generators in a
+    threadpool, which would add a thread hop for every token.
+    """
+    try:
+        # The engine yields ready-made SSE frames and ends after the one
+        # carrying the finish reason
+        async for frame in service.generate_stream_bytes(request, prompt):
+            yield frame
+        yield _SSE_DONE
 
     except Exception as e:
         logger.error(f"Streaming generation failed: {e}")
-        yield f"data: Error: {str(e)}\n\n"
-        yield f"data: [DONE]\n\n"
+        error = {"error": {"message": f"Error: {str(e)}"}}
+        yield _SSE_PREFIX + orjson.dumps(error) + _SSE_SUFFIX
+        yield _SSE_DONE
 
 
 @router.get("/models")
@@ -166,19 +277,21 @@ async def list_models(service: InferenceService = Depends(get_inference_service_
 
 
 @router.get("/stats")
-async def get_stats(service: InferenceService = Depends(get_inference_service_dep)):
+async def get_stats(
+    request: Request, service: InferenceService = Depends(get_inference_service_dep)
+):
     """
     Get inference service statistics.
 
     Returns performance and usage statistics.
     """
     try:
-        settings = get_settings()
+        settings = request.app.state.settings
 
         stats = {
             "service_ready": service.is_ready,
             "model_loaded": service.is_ready,
-            "queue_size": service.request_queue.qsize() if service.request_queue else 0,
+            "queue_size": service.approx_qsize,
             "batch_settings": {
                 "max_batch_size": settings.max_batch_size,
                 "batch_timeout": settings.batch_timeout,
@@ -187,6 +300,9 @@ async def get_stats(service: InferenceService = Depends(get_inference_service_de
                 "n_ctx": settings.n_ctx,
                 "n_gpu_layers": settings.n_gpu_layers,
                 "n_batch": settings.n_batch,
+                "n_ubatch": settings.n_ubatch,
+                "n_threads": settings.n_threads,
+                "n_threads_batch": settings.n_threads_batch,
             },
         }
 
@@ -9,13 +9,15 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import os
 import sys
 from contextlib import asynccontextmanager
 from typing import AsyncIterator
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from rich.console import Console
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
 
@@ -50,6 +52,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
             # Load settings
             status.update("[bold green]Loading configuration...")
             settings = get_settings()
+            app.state.settings = settings
             logger.info(f"Loading configuration from: {settings.model_path}")
 
             # Initialize service
@@ -57,7 +60,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
             service = get_inference_service()
 
             # Load the model
-            model_name = settings.model_path.split("/")[-1]
+            model_name = os.path.basename(settings.model_path)
             status.update(
                 f"[bold green]Loading model ([cyan]{model_name}[/cyan])... (This may take a moment)"
             )
@@ -68,7 +71,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
 
             # Clear the console and print the banner
             console.clear()
-            print_banner(console, settings)
+            print_banner(console, settings, n_layer=service.engine.n_layer)
 
             logger.info("✅ LLM Inference Server is ready to accept requests.")
 
@@ -98,6 +101,7 @@ def create_app() -> FastAPI:
         description="High-performance LLM inference server optimized for Apple M2 with dynamic batching",
         version="0.1.0",
         lifespan=lifespan,
+        default_response_class=ORJSONResponse,
         docs_url="/docs",
         redoc_url="/redoc",
         openapi_url="/openapi.json",
@@ -115,6 +119,13 @@ def create_app() -> FastAPI:
     # Include API router
     app.include_router(v1_router, prefix="/api/v1", tags=["Generation"])
 
+    # Prometheus metrics, served at the exact path (a mounted app would
+    # redirect /metrics to /metrics/)
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics() -> Response:
+        """Prometheus metrics in the text exposition format"""
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
     # Global exception handler
     @app.exception_handler(Exception)
     async def global_exception_handler(request, exc):
@@ -139,6 +150,7 @@ def create_app() -> FastAPI:
             "status": "running",
             "docs": "/docs",
             "api": "/api/v1",
+            "metrics": "/metrics",
         }
 
     return app
@@ -2,20 +2,15 @@
 
 from __future__ import annotations
 
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
-class GenerationRequest(BaseModel):
-    """Request model for text generation"""
+class SamplingParams(BaseModel):
+    """Sampling parameters shared by generation and chat requests"""
 
-    prompt: str = Field(
-        ...,
-        description="The input prompt for text generation",
-        min_length=1,
-        max_length=8192,
-    )
+    model_config = ConfigDict(extra="forbid", validate_default=False, frozen=True)
 
     max_tokens: int = Field(
         default=256, description="Maximum number of tokens to generate", ge=1, le=2048
@@ -31,8 +26,6 @@ class GenerationRequest(BaseModel):
 
     top_k: int = Field(default=40, description="Top-k sampling parameter", ge=1, le=100)
 
-    stream: bool = Field(default=False, description="Whether to stream the response")
-
     stop: Optional[list[str]] = Field(
         default=None, description="List of stop sequences"
     )
@@ -45,8 +38,12 @@ class GenerationRequest(BaseModel):
         default=None, description="Random seed for reproducible generation"
     )
 
-    class Config:
-        json_schema_extra = {
+
+class GenerationRequest(SamplingParams):
+    """Request model for text generation"""
+
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "prompt": "What is the capital of France?",
                 "max_tokens": 100,
@@ -58,4 +55,64 @@ class GenerationRequest(BaseModel):
                 "repeat_penalty": 1.1,
                 "seed": 42,
             }
-        }
+        },
+    )
+
+    prompt: str = Field(
+        ...,
+        description="The input prompt for text generation",
+        min_length=1,
+        max_length=8192,
+    )
+
+    stream: bool = Field(default=False, description="Whether to stream the response")
+
+    priority: int = Field(
+        default=0, description="Scheduling priority (lower values are served first)"
+    )
+
+    deadline_ms: Optional[int] = Field(
+        default=None,
+        description="Time budget in milliseconds; the request is dropped if it "
+        "has not been scheduled within it",
+        ge=1,
+    )
+
+
+class ChatMessage(BaseModel):
+    """One message of a chat conversation"""
+
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    role: Literal["system", "user", "assistant"] = Field(
+        ..., description="Author of the message"
+    )
+
+    content: str = Field(..., description="Message text", max_length=8192)
+
+
+class ChatRequest(SamplingParams):
+    """
+    Request model for chat completion.
+
+    Clients send the whole conversation each turn; the server renders it
+    with the model's prompt format and reuses the tokens of messages it
+    has already seen.
+    """
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "example": {
+                "messages": [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": "What is the capital of France?"},
+                ],
+                "max_tokens": 100,
+                "temperature": 0.7,
+            }
+        },
+    )
+
+    messages: list[ChatMessage] = Field(
+        ..., description="Conversation so far, oldest first", min_length=1
+    )
@@ -4,12 +4,14 @@ from __future__ import annotations
 
 from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class GenerationUsage(BaseModel):
     """Token usage statistics"""
 
+    model_config = ConfigDict(extra="forbid", validate_default=False)
+
     prompt_tokens: int = Field(description="Number of tokens in the prompt")
     completion_tokens: int = Field(description="Number of tokens in the completion")
     total_tokens: int = Field(description="Total number of tokens used")
@@ -18,6 +20,8 @@ class GenerationUsage(BaseModel):
 class GenerationChoice(BaseModel):
     """A single generation choice"""
 
+    model_config = ConfigDict(extra="forbid", validate_default=False)
+
     text: str = Field(description="The generated text")
     finish_reason: str = Field(description="Reason for stopping generation")
     index: int = Field(description="Index of this choice")
@@ -26,6 +30,8 @@ class GenerationChoice(BaseModel):
 class GenerationResponse(BaseModel):
     """Response model for text generation"""
 
+    model_config = ConfigDict(extra="forbid", validate_default=False)
+
     id: str = Field(description="Unique identifier for this generation")
     object: str = Field(default="text_completion", description="Object type")
     created: int = Field(
@@ -39,6 +45,8 @@ class GenerationResponse(BaseModel):
 class StreamingChunk(BaseModel):
     """A single chunk in a streaming response"""
 
+    model_config = ConfigDict(extra="forbid", validate_default=False)
+
     id: str = Field(description="Unique identifier for this generation")
     object: str = Field(default="text_completion", description="Object type")
     created: int = Field(
@@ -3,27 +3,87 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
 import logging
+import os
 import time
-import uuid
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from ...inference.engine import InferenceEngine
+from ...inference.engine import InferenceEngine, Prompt
 from ...lib.core.config import get_settings
-from ..schemas.request import GenerationRequest
+from ...lib.core.metrics import BATCH_SIZE, QUEUE_DEPTH, QUEUE_WAIT, REQUESTS, TOKENS
+from ..schemas.request import GenerationRequest, SamplingParams
 
 logger = logging.getLogger(__name__)
 
+_PROMPT_TOKENS = TOKENS.labels(kind="prompt")
+_COMPLETION_TOKENS = TOKENS.labels(kind="completion")
+
 
-@dataclass
 class BatchRequest:
-    """A batched request with metadata"""
+    """
+    A batched request with metadata.
+
+    Instances are recycled through InferenceService's pool, so fields are
+    reassigned in place rather than a new object being allocated per request.
+    """
+
+    __slots__ = (
+        "request_id",
+        "request",
+        "future",
+        "timestamp_ns",  # time.monotonic_ns() at arrival
+        "dedup_key",
+        "deadline_ns",  # time.monotonic_ns() expiry, if requested
+    )
+
+    def __init__(
+        self,
+        request_id: str,
+        request: GenerationRequest,
+        future: asyncio.Future,
+        timestamp_ns: int,
+        dedup_key: Optional[tuple] = None,
+        deadline_ns: Optional[int] = None,
+    ):
+        self.request_id = request_id
+        self.request = request
+        self.future = future
+        self.timestamp_ns = timestamp_ns
+        self.dedup_key = dedup_key
+        self.deadline_ns = deadline_ns
+
+
+def _sampling_key(request: GenerationRequest) -> tuple:
+    """Key identifying requests that can share a single engine batch call"""
+    return (
+        request.temperature,
+        request.top_p,
+        request.top_k,
+        request.repeat_penalty,
+        request.max_tokens,
+        request.seed,
+        tuple(request.stop or ()),
+    )
+
+
+def _dedup_key(request: GenerationRequest) -> Optional[tuple]:
+    """
+    Key identifying requests that are guaranteed to produce the same output.
 
-    request_id: str
-    request: GenerationRequest
-    future: asyncio.Future
-    timestamp: float
+    Returns None for stochastic requests (non-zero temperature without a seed),
+    which must never be deduplicated, and for requests with a deadline, whose
+    expiry would otherwise fail every request attached to them. Priority is
+    part of the key so a duplicate never waits behind a lower-priority one.
+    """
+    if request.temperature > 0 and request.seed is None:
+        return None
+    if request.deadline_ms is not None:
+        return None
+    return (request.prompt, request.priority, _sampling_key(request))
 
 
 class InferenceService:
@@ -36,11 +96,41 @@ class InferenceService:
 
     def __init__(self):
         self.settings = get_settings()
+        # Batching knobs read on every batch, bound once
+        self._max_batch_size = self.settings.max_batch_size
+        self._batch_timeout_ns = int(self.settings.batch_timeout * 1_000_000_000)
+        self._preferred_batch_size = self.settings.preferred_batch_size
+        self._ema_alpha = self.settings.ema_arrival_rate
+        self._max_batch_concurrency = self.settings.max_batch_concurrency
+        self._default_slo_ns = self.settings.default_slo_ms * 1_000_000
         self.engine: Optional[InferenceEngine] = None
-        self.request_queue: asyncio.Queue = asyncio.Queue()
-        self.batch_processor_task: Optional[asyncio.Task] = None
+        # Heap of (priority, deadline, seq, BatchRequest) entries; the sequence
+        # number keeps FIFO order among equal keys. _has_items is set whenever
+        # something is pushed.
+        self._queue: List[tuple] = []
+        self._queue_seq = itertools.count()
+        # Queue depth for monitoring, tracked independently of the queue itself
+        self._approx_qsize = 0
+        QUEUE_DEPTH.set_function(lambda: self._approx_qsize)
+        self._has_items = asyncio.Event()
+        self.batch_processor_tasks: List[asyncio.Task] = []
+        # Batches handed to the continuous batching scheduler, still running
+        self._batch_tasks: set[asyncio.Task] = set()
+        # Bounds how many batches run on the engine at the same time
+        self._engine_sem = asyncio.Semaphore(self._max_batch_concurrency)
         self.is_running = False
         self._lock = asyncio.Lock()
+        # Request ids are only used for logging, so a process-local counter
+        # behind a fixed pid prefix is enough (no OS entropy or syscall per
+        # request)
+        self._req_prefix = f"{os.getpid():x}-"
+        self._req_counter = itertools.count()
+        self._last_arrival_ns: Optional[int] = None
+        self._ema_interval_ns = float(self._batch_timeout_ns)
+        # Free list of BatchRequest objects for reuse
+        self._br_pool: collections.deque[BatchRequest] = collections.deque(maxlen=1024)
+        # Extra futures waiting on an identical in-flight request, by dedup key
+        self._inflight: Dict[tuple, List[asyncio.Future]] = {}
 
     async def initialize(self):
         """Initialize the inference service"""
@@ -53,21 +143,26 @@ class InferenceService:
 
             if not self.is_running:
                 self.is_running = True
-                self.batch_processor_task = asyncio.create_task(self._batch_processor())
-                logger.info("Batch processor started")
+                self.batch_processor_tasks = [
+                    asyncio.create_task(self._batch_processor())
+                    for _ in range(self._max_batch_concurrency)
+                ]
+                logger.info(
+                    f"Started {len(self.batch_processor_tasks)} batch processor(s)"
+                )
 
     async def shutdown(self):
         """Shutdown the inference service"""
         async with self._lock:
             if self.is_running:
                 self.is_running = False
-                if self.batch_processor_task:
-                    self.batch_processor_task.cancel()
-                    try:
-                        await self.batch_processor_task
-                    except asyncio.CancelledError:
-                        pass
-                logger.info("Batch processor stopped")
+                tasks = [*self.batch_processor_tasks, *self._batch_tasks]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self.batch_processor_tasks = []
+                self._batch_tasks.clear()
+                logger.info("Batch processors stopped")
 
             if self.engine:
                 await self.engine.shutdown()
@@ -87,17 +182,57 @@ class InferenceService:
         if not self.is_running or self.engine is None:
             raise RuntimeError("Inference service not initialized")
 
+        REQUESTS.inc()
+
         # Create a future to wait for the result
         future = asyncio.Future()
-        request_id = str(uuid.uuid4())
 
-        # Create batch request
-        batch_request = BatchRequest(
-            request_id=request_id, request=request, future=future, timestamp=time.time()
-        )
+        # Attach to an identical request that is already queued or running.
+        # No await happens between the lookup and the insert below, so this
+        # is atomic on the event loop.
+        dedup_key = _dedup_key(request)
+        if dedup_key is not None:
+            waiters = self._inflight.get(dedup_key)
+            if waiters is not None:
+                logger.debug("Attaching duplicate request to in-flight generation")
+                waiters.append(future)
+                return await future
+            self._inflight[dedup_key] = []
+
+        request_id = f"{self._req_prefix}{next(self._req_counter):x}"
+        now_ns = self._record_arrival()
+
+        if request.deadline_ms is not None:
+            deadline_ns = now_ns + request.deadline_ms * 1_000_000
+            sort_deadline_ns = deadline_ns
+        else:
+            deadline_ns = None
+            sort_deadline_ns = now_ns + self._default_slo_ns
+
+        # Create batch request, reusing a pooled instance when available
+        if self._br_pool:
+            batch_request = self._br_pool.pop()
+            BatchRequest.__init__(
+                batch_request,
+                request_id,
+                request,
+                future,
+                now_ns,
+                dedup_key,
+                deadline_ns,
+            )
+        else:
+            batch_request = BatchRequest(
+                request_id, request, future, now_ns, dedup_key, deadline_ns
+            )
 
-        # Add to queue
-        await self.request_queue.put(batch_request)
+        # Add to queue and wake the batch collector
+        heapq.heappush(
+            self._queue,
+            (request.priority, sort_deadline_ns, next(self._queue_seq), batch_request),
+        )
+        self._approx_qsize += 1
+        self._has_items.set()
 
         # Wait for result
         try:
@@ -107,6 +242,23 @@ class InferenceService:
             logger.error(f"Error processing request {request_id}: {e}")
             raise
 
+    def _record_arrival(self) -> int:
+        """
+        Update the moving average of the request inter-arrival time.
+
+        Returns:
+            The arrival time (time.monotonic_ns())
+        """
+        now_ns = time.monotonic_ns()
+        if self._last_arrival_ns is not None:
+            alpha = self._ema_alpha
+            self._ema_interval_ns = (
+                alpha * (now_ns - self._last_arrival_ns)
+                + (1 - alpha) * self._ema_interval_ns
+            )
+        self._last_arrival_ns = now_ns
+        return now_ns
+
     async def _batch_processor(self):
         """
         Background task that processes requests in batches.
@@ -124,8 +276,36 @@ class InferenceService:
                 if not batch_requests:
                     continue
 
-                # Process the batch
-                await self._process_batch(batch_requests)
+                # The scheduler admits new sequences between decode steps, so
+                # the batch is handed over without waiting for it to finish;
+                # the next one can join the running decode right away
+                if self.engine.continuous_batching:
+                    task = asyncio.create_task(self._process_batch(batch_requests))
+                    self._batch_tasks.add(task)
+                    task.add_done_callback(self._batch_tasks.discard)
+                    continue
+
+                # If a backlog of full batches is already queued, form them now
+                # and submit them together instead of running one collection
+                # cycle per batch. The engine semaphore still bounds how many
+                # of them run at once.
+                batches = [batch_requests]
+                while (
+                    len(batches) < self._max_batch_concurrency
+                    and len(self._queue) >= self._max_batch_size
+                ):
+                    extra_batch: List[BatchRequest] = []
+                    self._drain_queue(extra_batch)
+                    if extra_batch:
+                        batches.append(extra_batch)
+
+                # Process the batch(es)
+                if len(batches) == 1:
+                    await self._process_batch(batch_requests)
+                else:
+                    await asyncio.gather(
+                        *(self._process_batch(batch) for batch in batches)
+                    )
 
             except asyncio.CancelledError:
                 logger.info("Batch processor cancelled")
@@ -142,42 +322,100 @@ class InferenceService:
         Returns:
             List of batch requests to process
         """
-        batch_requests = []
-        batch_start_time = time.time()
-
         # Wait for first request
-        try:
-            first_request = await asyncio.wait_for(
-                self.request_queue.get(),
-                timeout=1.0,  # 1 second timeout to check if we should shutdown
-            )
-            batch_requests.append(first_request)
-        except asyncio.TimeoutError:
+        if not await self._wait_for_requests(
+            timeout=1.0  # 1 second timeout to check if we should shutdown
+        ):
             return []
 
-        # Collect additional requests until batch is full or timeout
-        while (
-            len(batch_requests) < self.settings.max_batch_size
-            and time.time() - batch_start_time < self.settings.batch_timeout
-        ):
-            try:
-                request = await asyncio.wait_for(
-                    self.request_queue.get(),
-                    timeout=max(
-                        0.01,
-                        self.settings.batch_timeout - (time.time() - batch_start_time),
-                    ),
+        start_ns = time.monotonic_ns()
+
+        # Pick how long to wait for the batch to fill. If a preferred-size batch
+        # is already queued, flush right away; otherwise wait roughly as long as
+        # the current arrival rate needs to deliver one, capped by batch_timeout.
+        # With continuous batching a request joins the running decode whenever
+        # it arrives, so holding it back to fill a batch only adds latency.
+        preferred_batch_size = self._preferred_batch_size
+        if len(self._queue) >= preferred_batch_size or self.engine.continuous_batching:
+            deadline_ns = start_ns
+        else:
+            deadline_ns = start_ns + int(
+                min(
+                    self._batch_timeout_ns, preferred_batch_size * self._ema_interval_ns
                 )
-                batch_requests.append(request)
-            except asyncio.TimeoutError:
+            )
+
+        # Collect requests until batch is full or timeout. Everything already
+        # queued is drained in one pass; we only wait again once it is empty.
+        batch_requests: List[BatchRequest] = []
+        while True:
+            self._drain_queue(batch_requests)
+
+            if len(batch_requests) >= self._max_batch_size:
+                break
+
+            remaining_ns = deadline_ns - time.monotonic_ns()
+            if remaining_ns <= 0 or not await self._wait_for_requests(
+                remaining_ns / 1_000_000_000
+            ):
                 break
 
         return batch_requests
 
+    def _drain_queue(self, batch_requests: List[BatchRequest]):
+        """
+        Move queued requests into a batch, most urgent first, until it is full.
+
+        Requests whose deadline has already passed are failed instead.
+
+        Args:
+            batch_requests: Batch to fill in place
+        """
+        queue = self._queue
+        max_batch_size = self._max_batch_size
+        now_ns = time.monotonic_ns()
+        while queue and len(batch_requests) < max_batch_size:
+            batch_request = heapq.heappop(queue)[-1]
+            self._approx_qsize -= 1
+            deadline_ns = batch_request.deadline_ns
+            if deadline_ns is not None and now_ns > deadline_ns:
+                self._complete(
+                    batch_request,
+                    error=TimeoutError(
+                        f"Request {batch_request.request_id} expired in queue"
+                    ),
+                )
+                continue
+            batch_requests.append(batch_request)
+
+    async def _wait_for_requests(self, timeout: float) -> bool:
+        """
+        Wait until the queue is non-empty.
+
+        Args:
+            timeout: Maximum time to wait (seconds)
+
+        Returns:
+            True if requests are available, False on timeout
+        """
+        if self._queue:
+            return True
+
+        self._has_items.clear()
+        try:
+            await asyncio.wait_for(self._has_items.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
     async def _process_batch(self, batch_requests: List[BatchRequest]):
         """
         Process a batch of requests.
 
+        Requests are grouped by their sampling parameters so that every request
+        is generated with its own settings. Each group is sent to the engine as
+        a sub-batch, and the sub-batches run concurrently.
+
         Args:
             batch_requests: List of requests to process
         """
@@ -185,79 +423,156 @@ class InferenceService:
             return
 
         logger.debug(f"Processing batch of {len(batch_requests)} requests")
+        BATCH_SIZE.observe(len(batch_requests))
+
+        # Group requests with identical sampling parameters, collecting each
+        # group's prompts in the same pass
+        now_ns = time.monotonic_ns()
+        groups: Dict[tuple, Tuple[List[BatchRequest], List[str]]] = {}
+        for batch_request in batch_requests:
+            QUEUE_WAIT.observe((now_ns - batch_request.timestamp_ns) / 1_000_000_000)
+            request = batch_request.request
+            key = _sampling_key(request)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = ([], [])
+            group[0].append(batch_request)
+            group[1].append(request.prompt)
+
+        if len(groups) > 1:
+            logger.debug(f"Batch split into {len(groups)} parameter groups")
+
+        await asyncio.gather(
+            *(self._process_group(group, prompts) for group, prompts in groups.values())
+        )
 
-        try:
-            # Extract prompts and parameters
-            prompts = [req.request.prompt for req in batch_requests]
-
-            # For now, use the first request's parameters for the entire batch
-            # In a more sophisticated implementation, you could group by similar parameters
-            first_request = batch_requests[0].request
-
-            # Generate responses for the batch
-            responses = await self.engine.generate_batch(
-                prompts=prompts,
-                max_tokens=first_request.max_tokens,
-                temperature=first_request.temperature,
-                top_p=first_request.top_p,
-                top_k=first_request.top_k,
-                stop=first_request.stop,
-                repeat_penalty=first_request.repeat_penalty,
-                seed=first_request.seed,
-            )
+    async def _process_group(self, group: List[BatchRequest], prompts: List[str]):
+        """
+        Process a group of requests sharing the same sampling parameters.
 
-            # Send results back to waiting requests
-            for i, batch_request in enumerate(batch_requests):
-                try:
-                    if i < len(responses):
-                        batch_request.future.set_result(responses[i])
-                    else:
-                        batch_request.future.set_exception(
-                            RuntimeError(
-                                f"No response for request {batch_request.request_id}"
-                            )
-                        )
-                except Exception as e:
-                    logger.error(
-                        f"Error setting result for request {batch_request.request_id}: {e}"
-                    )
-                    batch_request.future.set_exception(e)
+        Args:
+            group: List of requests with identical sampling parameters
+            prompts: The prompts of the requests in group, in the same order
+        """
+        pending = set(range(len(group)))
+        try:
+            params = group[0].request
+
+            # Generate responses for the group, handing each one back to its
+            # caller as soon as it is ready rather than when the group finishes.
+            # The scheduler runs groups concurrently in one decode, so only
+            # the static path takes an engine slot.
+            if self.engine.continuous_batching:
+                engine_slot = contextlib.nullcontext()
+            else:
+                engine_slot = self._engine_sem
+            async with engine_slot:
+                async for i, response in self.engine.generate_batch_streaming(
+                    prompts=prompts,
+                    max_tokens=params.max_tokens,
+                    temperature=params.temperature,
+                    top_p=params.top_p,
+                    top_k=params.top_k,
+                    stop=params.stop,
+                    repeat_penalty=params.repeat_penalty,
+                    seed=params.seed,
+                ):
+                    pending.discard(i)
+                    usage = response.get("usage")
+                    if usage:
+                        _PROMPT_TOKENS.inc(usage["prompt_tokens"])
+                        _COMPLETION_TOKENS.inc(usage["completion_tokens"])
+                    self._complete(group[i], result=response)
+
+            while pending:
+                i = pending.pop()
+                self._complete(
+                    group[i],
+                    error=RuntimeError(
+                        f"No response for request {group[i].request_id}"
+                    ),
+                )
 
         except Exception as e:
             logger.error(f"Error processing batch: {e}")
-            # Set exception for all requests in the batch
-            for batch_request in batch_requests:
-                try:
-                    batch_request.future.set_exception(e)
-                except Exception:
-                    pass  # Future might already be done
-
-    async def generate_stream(self, request: GenerationRequest):
+            # Set exception for all requests in the group still waiting
+            for i in pending:
+                self._complete(group[i], error=e)
+
+    def _complete(
+        self,
+        batch_request: BatchRequest,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[BaseException] = None,
+    ):
         """
-        Generate streaming response for a single request.
+        Resolve a request's future and those of any duplicates attached to it.
 
-        Note: Streaming is not batched as it requires individual handling.
+        The batch request is returned to the pool afterwards, so it must not be
+        used again by the caller.
 
         Args:
-            request: The generation request
+            batch_request: The request that was processed
+            result: Generated response, if successful
+            error: Exception to propagate, if generation failed
+        """
+        futures = [batch_request.future]
+        if batch_request.dedup_key is not None:
+            futures.extend(self._inflight.pop(batch_request.dedup_key, ()))
+
+        for future in futures:
+            if future.done():
+                continue  # Caller gave up (e.g. client disconnected)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        # Drop references so pooled objects don't keep requests alive
+        batch_request.request = batch_request.future = batch_request.dedup_key = None
+        self._br_pool.append(batch_request)
+
+    async def generate_stream_bytes(
+        self, request: SamplingParams, prompt: Optional[Prompt] = None
+    ):
+        """
+        Generate a streaming response as pre-encoded server-sent event frames.
+
+        Args:
+            request: The generation request, or the sampling settings of one
+            prompt: Prompt to generate from, defaults to request.prompt
 
         Yields:
-            Streaming response chunks
+            SSE frames, one per generated chunk
         """
         if not self.is_running or self.engine is None:
             raise RuntimeError("Inference service not initialized")
 
-        async for chunk in self.engine.generate_stream(
-            prompt=request.prompt,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature,
-            top_p=request.top_p,
-            top_k=request.top_k,
-            stop=request.stop,
-            repeat_penalty=request.repeat_penalty,
-            seed=request.seed,
-        ):
-            yield chunk
+        REQUESTS.inc()
+
+        usage: Dict[str, int] = {}
+        try:
+            async for frame in self.engine.generate_stream_bytes(
+                prompt=request.prompt if prompt is None else prompt,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+                stop=request.stop,
+                repeat_penalty=request.repeat_penalty,
+                seed=request.seed,
+                usage=usage,
+            ):
+                yield frame
+        finally:
+            # Counted even when the client disconnects mid-stream
+            _PROMPT_TOKENS.inc(usage.get("prompt_tokens", 0))
+            _COMPLETION_TOKENS.inc(usage.get("completion_tokens", 0))
+
+    @property
+    def approx_qsize(self) -> int:
+        """Approximate number of requests waiting to be batched"""
+        return self._approx_qsize
 
     @property
     def is_ready(self) -> bool:
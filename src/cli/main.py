@@ -4,7 +4,10 @@ A simple CLI application for chatting with the LLM inference server.
 
 from __future__ import annotations
 
+from typing import Dict, List, Optional
+
 import httpx
+import orjson
 import typer
 from rich.console import Console
 
@@ -12,7 +15,7 @@ from ..lib.core.config import get_settings
 
 # --- Configuration ---
 settings = get_settings()
-SERVER_URL = settings.server_url
+CHAT_STREAM_URL = settings.chat_stream_url
 APP_NAME = settings.app_name
 
 # --- Typer App and Console ---
@@ -24,45 +27,64 @@ app = typer.Typer(
 console = Console()
 
 
-def stream_chat(prompt: str, temperature: float, max_tokens: int):
-    """Handles the streaming chat logic."""
+def stream_chat(
+    client: httpx.Client,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+) -> Optional[str]:
+    """Handles the streaming chat logic.
+
+    Returns the assistant's reply, or None if the turn failed.
+    """
     console.print("[bold cyan]Assistant:[/bold cyan]", end=" ")
     full_response = ""
     try:
-        with httpx.stream(
+        with client.stream(
             "POST",
-            SERVER_URL,
+            CHAT_STREAM_URL,
             json={
-                "prompt": prompt,
+                "messages": messages,
                 "temperature": temperature,
                 "max_tokens": max_tokens,
-                "stream": True,
             },
-            timeout=None,
         ) as response:
             if response.status_code != 200:
                 console.print(
                     f"[bold red]Error: Server returned status {response.status_code}[/bold red]"
                 )
-                return
-
-            for chunk in response.iter_text():
-                if chunk.startswith("data: "):
-                    data_str = chunk[len("data: ") :].strip()
-                    if data_str == "[DONE]":
-                        break
-                    if data_str:
-                        console.print(f"[cyan]{data_str}[/cyan]", end="")
-                        full_response += data_str
+                return None
+
+            # One SSE event per "data: {json}" line
+            for line in response.iter_lines():
+                if not line.startswith("data: "):
+                    continue
+                payload = line[6:]
+                if payload == "[DONE]":
+                    break
+
+                event = orjson.loads(payload)
+                if "error" in event:
+                    console.print(f"[bold red]{event['error']['message']}[/bold red]")
+                    console.print()
+                    return None
+
+                text = event["choices"][0]["text"]
+                if text:
+                    console.print(text, style="cyan", end="", markup=False)
+                    full_response += text
     except httpx.ConnectError:
         console.print(
             "[bold red]Connection Error: Could not connect to the server.[/bold red]"
         )
         console.print("Please make sure the LLM inference server is running.")
+        return None
     except Exception as e:
         console.print(f"[bold red]An unexpected error occurred: {e}[/bold red]")
+        return None
 
     console.print()  # Newline after response
+    return full_response
 
 
 @app.command()
@@ -81,19 +103,33 @@ def chat(
     console.print("Type 'exit' or 'quit' to end the chat.")
     console.print("-" * 30)
 
-    while True:
-        try:
-            prompt = console.input("[bold yellow]You: [/bold yellow]")
-            if prompt.lower() in ["exit", "quit"]:
-                console.print("[bold red]Goodbye![/bold red]")
+    # The whole conversation is sent each turn; the server only tokenizes the
+    # messages it has not seen before
+    history: List[Dict[str, str]] = []
+
+    # One client for the whole session keeps the connection alive across turns
+    with httpx.Client(
+        timeout=None, limits=httpx.Limits(max_keepalive_connections=1)
+    ) as client:
+        while True:
+            try:
+                prompt = console.input("[bold yellow]You: [/bold yellow]")
+                if prompt.lower() in ["exit", "quit"]:
+                    console.print("[bold red]Goodbye![/bold red]")
+                    break
+
+                history.append({"role": "user", "content": prompt})
+                reply = stream_chat(client, history, temperature, max_tokens)
+                if reply is None:
+                    # Drop the failed turn so it can be retried
+                    history.pop()
+                else:
+                    history.append({"role": "assistant", "content": reply})
+
+            except KeyboardInterrupt:
+                console.print("\n[bold red]Goodbye![/bold red]")
                 break
 
-            stream_chat(prompt, temperature, max_tokens)
-
-        except KeyboardInterrupt:
-            console.print("\n[bold red]Goodbye![/bold red]")
-            break
-
 
 def run():
     """Entry point for the CLI application."""
@@ -0,0 +1,354 @@
+"""
+Multi-sequence decoding on a shared llama.cpp context.
+
+This module drives llama.cpp's low-level batch API directly so several
+prompts can be decoded together: every step packs one token per running
+sequence (plus any pending prompt tokens) into a single ``llama_batch``,
+runs one ``llama_decode`` and samples each sequence from its own logits.
+"""
+
+from __future__ import annotations
+
+import codecs
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import llama_cpp
+from llama_cpp import Llama
+
+logger = logging.getLogger(__name__)
+
+# (seq_id, text, finish_reason, completion_tokens) emitted by BatchDecoder.step
+DecodeEvent = Tuple[int, str, Optional[str], int]
+
+
+def _stop_holdback(text: str, stop: Sequence[str]) -> int:
+    """Length of the longest suffix of text that could start a stop sequence"""
+    longest = 0
+    for s in stop:
+        for k in range(min(len(s) - 1, len(text)), longest, -1):
+            if text.endswith(s[:k]):
+                longest = k
+                break
+    return longest
+
+
+class _Sequence:
+    """State for one sequence being decoded"""
+
+    __slots__ = (
+        "seq_id",
+        "prompt",
+        "prompt_pos",
+        "n_past",
+        "max_tokens",
+        "stop",
+        "sampler",
+        "next_token",
+        "logits_idx",
+        "n_generated",
+        "decoder",
+        "held",
+    )
+
+    def __init__(
+        self,
+        seq_id: int,
+        prompt: Sequence[int],
+        max_tokens: int,
+        stop: Sequence[str],
+        sampler,
+    ):
+        self.seq_id = seq_id
+        self.prompt = prompt
+        self.prompt_pos = 0
+        self.n_past = 0
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.sampler = sampler
+        self.next_token: Optional[int] = None
+        self.logits_idx = -1
+        self.n_generated = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.held = ""
+
+
+class BatchDecoder:
+    """
+    Decode several sequences at once on a dedicated llama.cpp context.
+
+    The context shares the weights of an already loaded Llama model and has
+    its own KV cache with room for n_seq_max sequences. Sequences can be
+    added and finish independently between steps. Admission is budgeted so
+    the prompt plus max_tokens of every running sequence fits in n_ctx.
+
+    Not thread-safe: callers must serialize access, e.g. by only using the
+    decoder from one task at a time.
+    """
+
+    def __init__(
+        self,
+        model: Llama,
+        n_ctx: int,
+        n_batch: int,
+        n_ubatch: int,
+        n_seq_max: int,
+        n_threads: Optional[int] = None,
+        n_threads_batch: Optional[int] = None,
+        flash_attn: bool = False,
+        type_k: Optional[int] = None,
+        type_v: Optional[int] = None,
+    ):
+        self._llama = model
+        self._n_ctx = n_ctx
+        self._n_batch = n_batch
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = min(n_ubatch, n_batch)
+        params.n_seq_max = n_seq_max
+        if n_threads:
+            params.n_threads = n_threads
+        if n_threads_batch or n_threads:
+            params.n_threads_batch = n_threads_batch or n_threads
+        params.flash_attn = flash_attn
+        if type_k is not None:
+            params.type_k = type_k
+        if type_v is not None:
+            params.type_v = type_v
+        # Let all sequences share one KV buffer instead of n_ctx / n_seq_max each
+        if hasattr(params, "kv_unified"):
+            params.kv_unified = True
+
+        self._ctx = llama_cpp.llama_init_from_model(model.model, params)
+        if not self._ctx:
+            raise RuntimeError("Failed to create llama.cpp context for batching")
+
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+        self._vocab = llama_cpp.llama_model_get_vocab(model.model)
+
+        self._free_ids = list(range(n_seq_max - 1, -1, -1))
+        self._active: Dict[int, _Sequence] = {}
+        self._reserved = 0
+
+        logger.info(
+            f"Batch decoder ready: {n_seq_max} sequences, {n_ctx} shared context"
+        )
+
+    @property
+    def has_active(self) -> bool:
+        """Whether any sequence is still being decoded"""
+        return bool(self._active)
+
+    def can_admit(self, n_tokens: int) -> bool:
+        """
+        Check whether a sequence needing n_tokens of KV cache can be added now.
+
+        Args:
+            n_tokens: Prompt length plus max_tokens of the candidate sequence
+
+        Returns:
+            True if a sequence slot and enough KV cache are free
+        """
+        return bool(self._free_ids) and self._reserved + n_tokens <= self._n_ctx
+
+    def fits(self, n_tokens: int) -> bool:
+        """Whether a sequence needing n_tokens could ever be admitted"""
+        return n_tokens <= self._n_ctx
+
+    def add(
+        self,
+        prompt_tokens: Sequence[int],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repeat_penalty: float,
+        stop: Optional[Sequence[str]] = None,
+        seed: Optional[int] = None,
+    ) -> int:
+        """
+        Start decoding a new sequence.
+
+        Its prompt is prefilled over the following steps, sharing each
+        llama_batch with the sequences already generating.
+
+        Args:
+            prompt_tokens: Tokenized prompt
+            max_tokens: Maximum tokens to generate
+            temperature: Sampling temperature
+            top_p: Top-p nucleus sampling
+            top_k: Top-k sampling
+            repeat_penalty: Repetition penalty
+            stop: Stop sequences
+            seed: Random seed for reproducibility
+
+        Returns:
+            Sequence id used in the events returned by step()
+        """
+        budget = len(prompt_tokens) + max_tokens
+        if not prompt_tokens or not self.can_admit(budget):
+            raise RuntimeError("No room in the batch for this sequence")
+
+        seq_id = self._free_ids.pop()
+        sampler = self._make_sampler(temperature, top_p, top_k, repeat_penalty, seed)
+        self._active[seq_id] = _Sequence(
+            seq_id, prompt_tokens, max_tokens, stop or (), sampler
+        )
+        self._reserved += budget
+        return seq_id
+
+    def step(self) -> List[DecodeEvent]:
+        """
+        Run one llama_decode over all running sequences and sample each.
+
+        Returns:
+            (seq_id, text, finish_reason, completion_tokens) for every
+            sequence that produced text or finished this step; finished
+            sequences are released
+        """
+        batch = self._batch
+        n = 0
+        sampling: List[_Sequence] = []
+
+        # One token per sequence that is already generating
+        for seq in self._active.values():
+            if seq.next_token is not None:
+                self._push(n, seq.next_token, seq.n_past, seq.seq_id, True)
+                seq.n_past += 1
+                seq.logits_idx = n
+                sampling.append(seq)
+                n += 1
+
+        # Fill the remaining room with prompt tokens (chunked prefill)
+        for seq in self._active.values():
+            remaining = len(seq.prompt) - seq.prompt_pos
+            if remaining <= 0 or n >= self._n_batch:
+                continue
+
+            take = min(remaining, self._n_batch - n)
+            for tok in seq.prompt[seq.prompt_pos : seq.prompt_pos + take]:
+                self._push(n, tok, seq.n_past, seq.seq_id, False)
+                seq.n_past += 1
+                n += 1
+            seq.prompt_pos += take
+
+            if seq.prompt_pos == len(seq.prompt):
+                batch.logits[n - 1] = 1
+                seq.logits_idx = n - 1
+                sampling.append(seq)
+
+        if n == 0:
+            return []
+
+        batch.n_tokens = n
+        rc = llama_cpp.llama_decode(self._ctx, batch)
+        if rc != 0:
+            raise RuntimeError(f"llama_decode failed with status {rc}")
+
+        events: List[DecodeEvent] = []
+        for seq in sampling:
+            token = llama_cpp.llama_sampler_sample(
+                seq.sampler, self._ctx, seq.logits_idx
+            )
+            event = self._advance(seq, token)
+            if event is not None:
+                events.append(event)
+
+        return events
+
+    def _advance(self, seq: _Sequence, token: int) -> Optional[DecodeEvent]:
+        """Apply a sampled token to a sequence and build its event"""
+        if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+            return self._finish(seq, seq.held, "stop")
+
+        seq.n_generated += 1
+        seq.next_token = token
+        seq.held += seq.decoder.decode(self._llama.detokenize([token]))
+
+        for s in seq.stop:
+            idx = seq.held.find(s)
+            if idx != -1:
+                return self._finish(seq, seq.held[:idx], "stop")
+
+        if seq.n_generated >= seq.max_tokens:
+            return self._finish(seq, seq.held, "length")
+
+        # Hold back text that may turn out to be the start of a stop sequence
+        keep = _stop_holdback(seq.held, seq.stop) if seq.stop else 0
+        text = seq.held[: len(seq.held) - keep]
+        seq.held = seq.held[len(text) :]
+        return (seq.seq_id, text, None, seq.n_generated) if text else None
+
+    def _finish(self, seq: _Sequence, text: str, reason: str) -> DecodeEvent:
+        """Release a finished sequence's slot, KV cells and sampler"""
+        self.remove(seq.seq_id)
+        return seq.seq_id, text, reason, seq.n_generated
+
+    def remove(self, seq_id: int):
+        """
+        Stop decoding a sequence and free its resources.
+
+        Args:
+            seq_id: Sequence id returned by add()
+        """
+        seq = self._active.pop(seq_id, None)
+        if seq is None:
+            return
+
+        llama_cpp.llama_kv_self_seq_rm(self._ctx, seq_id, -1, -1)
+        llama_cpp.llama_sampler_free(seq.sampler)
+        self._reserved -= len(seq.prompt) + seq.max_tokens
+        self._free_ids.append(seq_id)
+
+    def close(self):
+        """Free every sequence, the batch and the context"""
+        for seq_id in list(self._active):
+            self.remove(seq_id)
+
+        if self._batch is not None:
+            llama_cpp.llama_batch_free(self._batch)
+            self._batch = None
+        if self._ctx:
+            llama_cpp.llama_free(self._ctx)
+            self._ctx = None
+
+    def _push(self, n: int, token: int, pos: int, seq_id: int, logits: bool):
+        """Write one token into slot n of the llama_batch"""
+        batch = self._batch
+        batch.token[n] = token
+        batch.pos[n] = pos
+        batch.n_seq_id[n] = 1
+        batch.seq_id[n][0] = seq_id
+        batch.logits[n] = logits
+
+    @staticmethod
+    def _make_sampler(
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repeat_penalty: float,
+        seed: Optional[int],
+    ):
+        """Build a llama.cpp sampler chain for one sequence"""
+        chain = llama_cpp.llama_sampler_chain_init(
+            llama_cpp.llama_sampler_chain_default_params()
+        )
+        add = llama_cpp.llama_sampler_chain_add
+
+        add(chain, llama_cpp.llama_sampler_init_penalties(64, repeat_penalty, 0.0, 0.0))
+        if temperature <= 0:
+            add(chain, llama_cpp.llama_sampler_init_greedy())
+            return chain
+
+        add(chain, llama_cpp.llama_sampler_init_top_k(top_k))
+        add(chain, llama_cpp.llama_sampler_init_top_p(top_p, 1))
+        add(chain, llama_cpp.llama_sampler_init_temp(temperature))
+        add(
+            chain,
+            llama_cpp.llama_sampler_init_dist(
+                llama_cpp.LLAMA_DEFAULT_SEED if seed is None else seed
+            ),
+        )
+        return chain
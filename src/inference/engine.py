@@ -8,18 +8,167 @@ with Metal Performance Shaders (MPS) acceleration.
 from __future__ import annotations
 
 import asyncio
+import collections
+import concurrent.futures
+import itertools
 import logging
+import os
+import threading
 import time
 import uuid
-from typing import Any, AsyncIterator, Dict, List, Optional
-
-from llama_cpp import Llama
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import orjson
 
 from ..lib.core.config import Settings
+from ..lib.core.cpu import pin_to_performance_cores
+from .prompt_templates import PromptFormat, TokenizedChatBuilder, prompt_manager
+from .scheduler import Scheduler, Submission
+
+# llama_cpp loads the native library on import, so it is only imported
+# once a model is actually loaded
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+
+    from .batch_decoder import BatchDecoder
 
 logger = logging.getLogger(__name__)
 
 
+# Completion ids are a per-process boot tag plus a counter, so no entropy is
+# drawn per request
+_BOOT = uuid.uuid4().hex[:8]
+_SEQ = itertools.count()
+
+
+def _completion_id() -> str:
+    """Return a new process-unique completion id"""
+    return f"cmpl-{_BOOT}-{next(_SEQ):x}"
+
+
+# A prompt as text, or as token ids that are passed to llama.cpp unchanged
+Prompt = Union[str, Sequence[int]]
+
+
+def _sampling_params(
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    stop: Optional[List[str]],
+    repeat_penalty: float,
+    seed: Optional[int],
+) -> Dict[str, Any]:
+    """
+    Collect a request's sampling parameters.
+
+    The dict is built once per batch or stream and shared by every prompt;
+    llama.cpp kwargs are this merged with the prompt and stream flag.
+    """
+    return {
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "repeat_penalty": repeat_penalty,
+        "stop": stop,
+        "seed": seed,
+    }
+
+
+def _encode(model: Llama, prompt: str) -> Tuple[int, ...]:
+    """Tokenize a prompt the way create_completion would"""
+    return tuple(model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True))
+
+
+def _is_special_token(model: Llama, text: str) -> bool:
+    """Check if the model's vocabulary has text as a single special token"""
+    data = text.encode("utf-8")
+    tokens = model.tokenize(data, add_bos=False, special=True)
+    # A special token is split into plain text when parse_special is off
+    return (
+        len(tokens) == 1
+        and model.tokenize(data, add_bos=False, special=False) != tokens
+    )
+
+
+# ggml_type ids for the KV cache data types accepted in settings
+_KV_CACHE_TYPES = {
+    "f32": 0,
+    "f16": 1,
+    "q4_0": 2,
+    "q4_1": 3,
+    "q5_0": 6,
+    "q5_1": 7,
+    "q8_0": 8,
+}
+
+# Constant fields of the result returned for a failed prompt; the usage
+# dict is shared between results and never mutated
+_BATCH_ERROR_TEMPLATE: Dict[str, Any] = {
+    "object": "text_completion",
+    "usage": {
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+    },
+}
+
+# Prompts whose token ids are kept for reuse by the context check and the
+# generate paths
+_TOKEN_CACHE_SIZE = 1024
+# Chat conversations whose per-message token ids are kept for later turns
+_CHAT_CACHE_SIZE = 256
+
+_SENTINEL = object()
+
+# Server-sent event framing for generate_stream_bytes; the suffix also
+# closes the chunk object opened by the pre-serialized envelope
+_FRAME_PREFIX = b"data: "
+_FRAME_SUFFIX = b"}\n\n"
+
+
+def _drain(
+    model: Llama,
+    kwargs: Dict[str, Any],
+    loop: asyncio.AbstractEventLoop,
+    q: asyncio.Queue,
+    stop_event: threading.Event,
+):
+    """
+    Run a streaming completion on the executor thread.
+
+    Each chunk is handed to the event loop with call_soon_threadsafe, and
+    stop_event ends generation once the consumer is gone. The producer never
+    waits for the consumer: this is the only llama thread, so a client that
+    stops reading would otherwise stall every other generation. The queue
+    is bounded in practice by max_tokens.
+    """
+    try:
+        # The consumer may have gone away while this job was queued
+        if stop_event.is_set():
+            return
+        for chunk in model(**kwargs):
+            if stop_event.is_set():
+                break
+            loop.call_soon_threadsafe(q.put_nowait, chunk)
+    except Exception as e:
+        loop.call_soon_threadsafe(q.put_nowait, e)
+    finally:
+        loop.call_soon_threadsafe(q.put_nowait, _SENTINEL)
+
+
 class InferenceEngine:
     """
     High-performance inference engine using llama-cpp-python.
@@ -30,14 +179,35 @@ class InferenceEngine:
 
     def __init__(self, settings: Settings):
         self.settings = settings
-        self.model: Optional[Llama] = None
-        self.model_name = "unknown"
+        # (model, model name), swapped as a whole so readers never need the lock
+        self._state: Tuple[Optional[Llama], str] = (None, "unknown")
+        self.n_layer: Optional[int] = None
+        self.model_name_lower = "unknown"
+        self.prompt_format = PromptFormat.PLAIN
         self._lock = asyncio.Lock()
+        # All llama.cpp work runs on this one thread, so calls are serialized
+        # instead of contending for the model from the default pool. Pinning
+        # it also places the worker threads llama.cpp spawns from it
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="llama",
+            initializer=pin_to_performance_cores if settings.pin_threads else None,
+        )
+        self._decoder: Optional[BatchDecoder] = None
+        self._scheduler: Optional[Scheduler] = None
+        # Prompt text -> token ids, in LRU order; only touched on the event loop
+        self._token_cache: collections.OrderedDict[str, Tuple[int, ...]] = (
+            collections.OrderedDict()
+        )
+        # Conversation, as (role, content) pairs -> builder holding its tokens
+        self._chat_cache: collections.OrderedDict[
+            Tuple[Tuple[str, str], ...], TokenizedChatBuilder
+        ] = collections.OrderedDict()
 
     async def initialize(self):
         """Initialize the inference engine and load the model"""
         async with self._lock:
-            if self.model is not None:
+            if self._state[0] is not None:
                 logger.info("Model already loaded")
                 return
 
@@ -49,12 +219,24 @@ class InferenceEngine:
                     f"Model file not found: {self.settings.model_path}"
                 )
 
+            # llama.cpp can only quantize the V cache with flash attention
+            type_v = self.settings.type_v
+            if not self.settings.flash_attn and type_v not in ("f16", "f32"):
+                logger.warning(
+                    f"type_v={type_v} requires flash_attn; using f16 for the V cache"
+                )
+                type_v = "f16"
+
             # Configure model parameters for Apple M2
             model_kwargs = {
                 "model_path": self.settings.model_path,
                 "n_gpu_layers": self.settings.n_gpu_layers,  # Offload to Metal GPU
                 "n_ctx": self.settings.n_ctx,
                 "n_batch": self.settings.n_batch,
+                "n_ubatch": self.settings.n_ubatch,
+                "flash_attn": self.settings.flash_attn,
+                "type_k": _KV_CACHE_TYPES[self.settings.type_k],
+                "type_v": _KV_CACHE_TYPES[type_v],
                 "use_mlock": self.settings.use_mlock,
                 "use_mmap": self.settings.use_mmap,
                 "verbose": self.settings.verbose,
@@ -64,41 +246,229 @@ class InferenceEngine:
             # Add threads if specified
             if self.settings.n_threads:
                 model_kwargs["n_threads"] = self.settings.n_threads
+            if self.settings.n_threads_batch:
+                model_kwargs["n_threads_batch"] = self.settings.n_threads_batch
 
             try:
+                import llama_cpp
+                from llama_cpp import Llama, LlamaRAMCache
+
                 # Load model in thread pool to avoid blocking
-                loop = asyncio.get_event_loop()
-                self.model = await loop.run_in_executor(
-                    None, lambda: Llama(**model_kwargs)
+                loop = asyncio.get_running_loop()
+                model = await loop.run_in_executor(
+                    self._executor, lambda: Llama(**model_kwargs)
                 )
 
-                # Extract model name from path
-                self.model_name = self.settings.model_path.split("/")[-1]
-
-                logger.info(f"Model loaded successfully: {self.model_name}")
+                self.n_layer = llama_cpp.llama_model_n_layer(model.model)
+                if 0 <= self.settings.n_gpu_layers < self.n_layer:
+                    logger.warning(
+                        f"Only {self.settings.n_gpu_layers} of {self.n_layer} layers "
+                        "are offloaded to the GPU; set N_GPU_LAYERS=-1 to offload all"
+                    )
+
+                # Reuse the KV state of previously seen prompt prefixes
+                if self.settings.prompt_cache_bytes > 0:
+                    model.set_cache(
+                        LlamaRAMCache(capacity_bytes=self.settings.prompt_cache_bytes)
+                    )
+
+                if self.settings.prompt_cache_prewarm:
+                    await self._prewarm(model, self.settings.prompt_cache_prewarm)
+
+                if self.settings.enable_continuous_batching:
+                    from .batch_decoder import BatchDecoder
+
+                    self._decoder = await loop.run_in_executor(
+                        self._executor,
+                        lambda: BatchDecoder(
+                            model,
+                            n_ctx=self.settings.n_ctx,
+                            n_batch=self.settings.n_batch,
+                            n_ubatch=self.settings.n_ubatch,
+                            n_seq_max=self.settings.max_batch_size,
+                            n_threads=self.settings.n_threads,
+                            n_threads_batch=self.settings.n_threads_batch,
+                            flash_attn=model_kwargs["flash_attn"],
+                            type_k=model_kwargs["type_k"],
+                            type_v=model_kwargs["type_v"],
+                        ),
+                    )
+                    self._scheduler = Scheduler(self._decoder, self._executor)
+                    await self._scheduler.start()
+
+                # Extract model name from path and detect its prompt format once
+                model_name = os.path.basename(self.settings.model_path)
+                self.model_name_lower = model_name.lower()
+                self.prompt_format = prompt_manager.detect_format(self.model_name_lower)
+                self._state = (model, model_name)
+
+                logger.info(f"Model loaded successfully: {model_name}")
+                logger.info(f"Prompt format: {self.prompt_format.value}")
                 logger.info(f"Context size: {self.settings.n_ctx}")
                 logger.info(f"GPU layers: {self.settings.n_gpu_layers}")
+                logger.info(
+                    f"Threads: {self.settings.n_threads} generation, "
+                    f"{self.settings.n_threads_batch} prompt processing"
+                )
 
             except Exception as e:
                 logger.error(f"Failed to load model: {e}")
                 raise
 
+    async def _prewarm(self, model: Llama, prefix: str):
+        """Evaluate a shared prompt prefix once so its KV state is cached"""
+        tokens = list(_encode(model, prefix))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self._executor,
+            lambda: model(prompt=tokens, max_tokens=1, temperature=0.0),
+        )
+        logger.info(f"Prompt cache prewarmed with {len(tokens)} tokens")
+
     async def shutdown(self):
         """Shutdown the inference engine"""
         async with self._lock:
-            if self.model is not None:
+            if self._scheduler is not None:
+                await self._scheduler.stop()
+                self._scheduler = None
+                self._decoder.close()
+                self._decoder = None
+
+            if self._state[0] is not None:
                 # llama-cpp-python handles cleanup automatically
-                self.model = None
+                self._state = (None, "unknown")
+                self.model_name_lower = "unknown"
+                self.prompt_format = PromptFormat.PLAIN
+                self._token_cache.clear()
+                self._chat_cache.clear()
                 logger.info("Model unloaded")
 
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
     @property
     def is_loaded(self) -> bool:
         """Check if the model is loaded"""
-        return self.model is not None
+        return self._state[0] is not None
+
+    @property
+    def continuous_batching(self) -> bool:
+        """Check if generation runs through the continuous batching scheduler"""
+        return self._scheduler is not None
+
+    async def tokenize_len(self, prompt: str) -> int:
+        """
+        Count the tokens a prompt encodes to.
+
+        Token ids are cached and reused by the generate paths, so a prompt
+        counted here is not tokenized again when it is generated.
+
+        Args:
+            prompt: Input prompt
+
+        Returns:
+            Number of prompt tokens, including BOS
+        """
+        return len(await self._prompt_tokens(prompt))
+
+    async def _prompt_tokens(self, prompt: Prompt) -> Sequence[int]:
+        """
+        Token ids of a prompt given as text or as token ids.
+
+        Text is tokenized on the default thread pool rather than the event
+        loop or the llama thread, so a long prompt neither stalls the loop
+        nor waits behind a running generation. Tokenizing only reads the
+        vocabulary, so it is safe alongside decoding.
+        """
+        if not isinstance(prompt, str):
+            return prompt
+
+        cache = self._token_cache
+        tokens = cache.get(prompt)
+        if tokens is not None:
+            cache.move_to_end(prompt)
+            return tokens
+
+        model = self._state[0]
+        if model is None:
+            raise RuntimeError("Model not loaded")
+
+        loop = asyncio.get_running_loop()
+        tokens = await loop.run_in_executor(None, _encode, model, prompt)
+        cache[prompt] = tokens
+        if len(cache) > _TOKEN_CACHE_SIZE:
+            cache.popitem(last=False)
+        return tokens
+
+    async def chat_prompt_tokens(self, messages: Sequence[Dict[str, str]]) -> List[int]:
+        """
+        Token ids of a conversation rendered in the model's prompt format.
+
+        Conversations are cached by their messages. A turn that extends a
+        cached conversation (its earlier messages, the assistant's reply and
+        a new user message) only renders and tokenizes the new messages,
+        provided the model's vocabulary has the template's message markers
+        as special tokens; otherwise the whole conversation is tokenized.
+        Tokenizing runs on the default thread pool.
+
+        Args:
+            messages: Conversation as role/content dicts, oldest first
+
+        Returns:
+            Prompt token ids for the assistant's next reply
+        """
+        model = self._state[0]
+        if model is None:
+            raise RuntimeError("Model not loaded")
+
+        key = tuple((m["role"], m["content"]) for m in messages)
+        cache = self._chat_cache
+
+        # Longest already tokenized prefix of this conversation
+        cached: Optional[TokenizedChatBuilder] = None
+        n_cached = len(key)
+        while n_cached > 0:
+            cached = cache.get(key[:n_cached])
+            if cached is not None:
+                cache.move_to_end(key[:n_cached])
+                break
+            n_cached -= 1
+
+        if cached is not None and n_cached == len(key):
+            return cached.prompt_tokens()
+
+        def extend() -> Tuple[TokenizedChatBuilder, List[int]]:
+            builder = cached.copy() if cached else self._new_chat_builder(model)
+            for role, content in key[n_cached:]:
+                builder.add_message(role, content)
+            return builder, builder.prompt_tokens()
+
+        loop = asyncio.get_running_loop()
+        builder, tokens = await loop.run_in_executor(None, extend)
+        cache[key] = builder
+        if len(cache) > _CHAT_CACHE_SIZE:
+            cache.popitem(last=False)
+        return tokens
+
+    def _new_chat_builder(self, model: Llama) -> TokenizedChatBuilder:
+        """Empty chat builder using the loaded model's format and tokenizer"""
+        template = prompt_manager.get_template(self.prompt_format)
+        return TokenizedChatBuilder(
+            template,
+            lambda text: model.tokenize(
+                text.encode("utf-8"), add_bos=False, special=True
+            ),
+            # BOS, if the model adds one
+            prefix=model.tokenize(b"", add_bos=True, special=True),
+            special_prefixes=[
+                marker
+                for marker in template.chat_special_prefixes
+                if _is_special_token(model, marker)
+            ],
+        )
 
     async def generate_batch(
         self,
-        prompts: List[str],
+        prompts: List[Prompt],
         max_tokens: int = 256,
         temperature: float = 0.7,
         top_p: float = 0.9,
@@ -111,7 +481,7 @@ class InferenceEngine:
         Generate text for a batch of prompts.
 
         Args:
-            prompts: List of input prompts
+            prompts: List of input prompts, as text or token ids
             max_tokens: Maximum tokens to generate per prompt
             temperature: Sampling temperature
             top_p: Top-p nucleus sampling
@@ -123,7 +493,7 @@ class InferenceEngine:
         Returns:
             List of generation results
         """
-        if not self.is_loaded:
+        if self._state[0] is None:
             raise RuntimeError("Model not loaded")
 
         if not prompts:
@@ -131,53 +501,24 @@ class InferenceEngine:
 
         logger.debug(f"Generating batch of {len(prompts)} prompts")
 
-        # Process prompts sequentially within the batch call
-        # This resolves issues with the underlying library's batch handling
-        # while still benefiting from the service-level dynamic batching.
-        results = []
-        for i, prompt in enumerate(prompts):
-            try:
-                result = await self._generate_single(
-                    prompt=prompt,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    top_k=top_k,
-                    stop=stop,
-                    repeat_penalty=repeat_penalty,
-                    seed=seed,
-                )
-                results.append(result)
-
-            except Exception as e:
-                logger.error(f"Error generating for prompt {i}: {e}")
-                # Return error result for this prompt
-                results.append(
-                    {
-                        "id": str(uuid.uuid4()),
-                        "object": "text_completion",
-                        "created": int(time.time()),
-                        "model": self.model_name,
-                        "choices": [
-                            {
-                                "text": f"Error: {str(e)}",
-                                "finish_reason": "error",
-                                "index": i,
-                            }
-                        ],
-                        "usage": {
-                            "prompt_tokens": 0,
-                            "completion_tokens": 0,
-                            "total_tokens": 0,
-                        },
-                    }
-                )
+        results: List[Optional[Dict[str, Any]]] = [None] * len(prompts)
+        async for i, result in self.generate_batch_streaming(
+            prompts=prompts,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            stop=stop,
+            repeat_penalty=repeat_penalty,
+            seed=seed,
+        ):
+            results[i] = result
 
         return results
 
-    async def _generate_single(
+    async def generate_batch_streaming(
         self,
-        prompt: str,
+        prompts: List[Prompt],
         max_tokens: int = 256,
         temperature: float = 0.7,
         top_p: float = 0.9,
@@ -185,67 +526,175 @@ class InferenceEngine:
         stop: Optional[List[str]] = None,
         repeat_penalty: float = 1.1,
         seed: Optional[int] = None,
-    ) -> Dict[str, Any]:
-        """Generate text for a single prompt"""
-        if not self.is_loaded:
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Generate text for a batch of prompts, yielding each result as it completes.
+
+        Args:
+            prompts: List of input prompts, as text or token ids
+            max_tokens: Maximum tokens to generate per prompt
+            temperature: Sampling temperature
+            top_p: Top-p nucleus sampling
+            top_k: Top-k sampling
+            stop: Stop sequences
+            repeat_penalty: Repetition penalty
+            seed: Random seed for reproducibility
+
+        Yields:
+            Tuples of (prompt index, generation result)
+        """
+        if self._state[0] is None:
             raise RuntimeError("Model not loaded")
 
-        generation_id = str(uuid.uuid4())
+        # Shared by every prompt of the batch
         created_time = int(time.time())
+        params = _sampling_params(
+            max_tokens, temperature, top_p, top_k, stop, repeat_penalty, seed
+        )
 
-        # Prepare generation parameters
-        generation_kwargs = {
-            "prompt": prompt,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
-            "repeat_penalty": repeat_penalty,
-            "stream": False,
-        }
+        if self._scheduler is not None:
+            # Submit every prompt at once; the scheduler decodes them together
+            async def run_one(i: int, prompt: Prompt) -> Tuple[int, Dict[str, Any]]:
+                try:
+                    return i, await self._generate_single(prompt, params)
+                except Exception as e:
+                    logger.error(f"Error generating for prompt {i}: {e}")
+                    return i, self._error_result(i, e, created_time)
+
+            tasks = [
+                asyncio.ensure_future(run_one(i, prompt))
+                for i, prompt in enumerate(prompts)
+            ]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield await next_done
+            finally:
+                for task in tasks:
+                    task.cancel()
+            return
 
-        if stop:
-            generation_kwargs["stop"] = stop
+        # Process prompts sequentially within the batch call
+        # This resolves issues with the underlying library's batch handling
+        # while still benefiting from the service-level dynamic batching.
+        for i, prompt in enumerate(prompts):
+            try:
+                result = await self._generate_single(prompt, params)
 
-        if seed is not None:
-            generation_kwargs["seed"] = seed
+            except Exception as e:
+                logger.error(f"Error generating for prompt {i}: {e}")
+                # Return error result for this prompt
+                result = self._error_result(i, e, created_time)
+
+            yield i, result
+
+    def _error_result(
+        self, i: int, error: Exception, created_time: int
+    ) -> Dict[str, Any]:
+        """Build the result returned for a prompt whose generation failed"""
+        result = _BATCH_ERROR_TEMPLATE.copy()
+        result["id"] = _completion_id()
+        result["created"] = created_time
+        result["model"] = self._state[1]
+        result["choices"] = [
+            {"text": f"Error: {error}", "finish_reason": "error", "index": i}
+        ]
+        return result
+
+    async def _generate_single(
+        self, prompt: Prompt, params: Mapping[str, Any]
+    ) -> Dict[str, Any]:
+        """Generate text for a single prompt with the given sampling parameters"""
+        # Bind the model once so a concurrent shutdown cannot swap it mid-call
+        model, model_name = self._state
+        if model is None:
+            raise RuntimeError("Model not loaded")
+
+        generation_id = _completion_id()
+        created_time = int(time.time())
+
+        if self._scheduler is not None:
+            choice, usage = await self._generate_scheduled(prompt, params)
+        else:
+            generation_kwargs = {
+                **params,
+                "prompt": list(await self._prompt_tokens(prompt)),
+                "stream": False,
+            }
 
-        try:
             # Generate in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
+            loop = asyncio.get_running_loop()
             result = await loop.run_in_executor(
-                None, lambda: self.model(**generation_kwargs)
+                self._executor, lambda: model(**generation_kwargs)
             )
-
-            # Format response
             choice = result["choices"][0]
+            usage = result["usage"]
 
-            return {
-                "id": generation_id,
-                "object": "text_completion",
-                "created": created_time,
-                "model": self.model_name,
-                "choices": [
-                    {
-                        "text": choice["text"],
-                        "finish_reason": choice["finish_reason"],
-                        "index": 0,
-                    }
-                ],
-                "usage": {
-                    "prompt_tokens": result["usage"]["prompt_tokens"],
-                    "completion_tokens": result["usage"]["completion_tokens"],
-                    "total_tokens": result["usage"]["total_tokens"],
-                },
-            }
+        # Format response
+        return {
+            "id": generation_id,
+            "object": "text_completion",
+            "created": created_time,
+            "model": model_name,
+            "choices": [
+                {
+                    "text": choice["text"],
+                    "finish_reason": choice["finish_reason"],
+                    "index": 0,
+                }
+            ],
+            "usage": {
+                "prompt_tokens": usage["prompt_tokens"],
+                "completion_tokens": usage["completion_tokens"],
+                "total_tokens": usage["total_tokens"],
+            },
+        }
 
-        except Exception as e:
-            logger.error(f"Error in single generation: {e}")
-            raise
+    async def _generate_scheduled(
+        self, prompt: Prompt, params: Mapping[str, Any]
+    ) -> Tuple[Dict[str, Any], Dict[str, int]]:
+        """Generate a completion through the continuous batching scheduler"""
+        submission = await self._submit(prompt, params)
+
+        parts: List[str] = []
+        finish_reason = None
+        completion_tokens = 0
+        async for text, finish_reason, completion_tokens in self._scheduled_events(
+            submission
+        ):
+            parts.append(text)
+
+        prompt_tokens = len(submission.prompt_tokens)
+        choice = {"text": "".join(parts), "finish_reason": finish_reason}
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return choice, usage
+
+    async def _submit(self, prompt: Prompt, params: Mapping[str, Any]) -> Submission:
+        """Tokenize a prompt and queue it on the scheduler"""
+        prompt_tokens = await self._prompt_tokens(prompt)
+        return self._scheduler.submit(prompt_tokens, **params)
 
-    async def generate_stream(
+    async def _scheduled_events(
+        self, submission: Submission
+    ) -> AsyncIterator[Tuple[str, Optional[str], int]]:
+        """Yield a submission's events until it finishes, cancelling it on exit"""
+        try:
+            while True:
+                event = await submission.out.get()
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+                if event[1] is not None:
+                    return
+        finally:
+            submission.cancel()
+
+    async def generate_stream_bytes(
         self,
-        prompt: str,
+        prompt: Prompt,
         max_tokens: int = 256,
         temperature: float = 0.7,
         top_p: float = 0.9,
@@ -253,12 +702,17 @@ class InferenceEngine:
         stop: Optional[List[str]] = None,
         repeat_penalty: float = 1.1,
         seed: Optional[int] = None,
-    ) -> AsyncIterator[Dict[str, Any]]:
+        usage: Optional[Dict[str, int]] = None,
+    ) -> AsyncIterator[bytes]:
         """
-        Generate streaming text for a single prompt.
+        Generate streaming text as pre-encoded server-sent event frames.
+
+        The constant part of each chunk (id, object, created, model) is
+        serialized once per request; only the choices are serialized per
+        token. Empty chunks are skipped unless they carry the finish reason.
 
         Args:
-            prompt: Input prompt
+            prompt: Input prompt, or its token ids
             max_tokens: Maximum tokens to generate
             temperature: Sampling temperature
             top_p: Top-p nucleus sampling
@@ -266,96 +720,111 @@ class InferenceEngine:
             stop: Stop sequences
             repeat_penalty: Repetition penalty
             seed: Random seed for reproducibility
+            usage: Filled in with prompt_tokens and completion_tokens as the
+                stream progresses, so counts are available even if it ends
+                early
 
         Yields:
-            Streaming response chunks
+            SSE frames whose data is a chunk in the StreamingChunk shape
         """
-        if not self.is_loaded:
+        model, model_name = self._state
+        if model is None:
             raise RuntimeError("Model not loaded")
 
-        generation_id = str(uuid.uuid4())
-        created_time = int(time.time())
-
-        # Prepare generation parameters
-        generation_kwargs = {
-            "prompt": prompt,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
-            "repeat_penalty": repeat_penalty,
-            "stream": True,
-        }
-
-        if stop:
-            generation_kwargs["stop"] = stop
-
-        if seed is not None:
-            generation_kwargs["seed"] = seed
-
-        try:
-            # Create streaming generator in thread pool
-            loop = asyncio.get_event_loop()
-
-            # We need to handle streaming in a more complex way
-            # since we can't directly await a generator
-            stream_queue = asyncio.Queue()
-
-            async def stream_worker():
-                """Worker function to handle streaming in thread pool"""
-                try:
+        envelope = b"".join(
+            (
+                _FRAME_PREFIX,
+                b'{"id":',
+                orjson.dumps(_completion_id()),
+                b',"object":"text_completion","created":',
+                str(int(time.time())).encode(),
+                b',"model":',
+                orjson.dumps(model_name),
+                b',"choices":',
+            )
+        )
 
-                    def run_stream():
-                        return self.model(**generation_kwargs)
+        params = _sampling_params(
+            max_tokens, temperature, top_p, top_k, stop, repeat_penalty, seed
+        )
 
-                    stream_iter = await loop.run_in_executor(None, run_stream)
+        if usage is None:
+            usage = {}
+        usage["prompt_tokens"] = usage["completion_tokens"] = 0
 
-                    for chunk in stream_iter:
-                        await stream_queue.put(chunk)
+        async for text, finish_reason in self._stream_choices(
+            model, prompt, params, usage
+        ):
+            if text or finish_reason:
+                choices = [{"text": text, "finish_reason": finish_reason, "index": 0}]
+                yield envelope + orjson.dumps(choices) + _FRAME_SUFFIX
 
-                    await stream_queue.put(None)  # Signal end
+    async def _stream_choices(
+        self,
+        model: Llama,
+        prompt: Prompt,
+        params: Mapping[str, Any],
+        usage: Dict[str, int],
+    ) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """
+        Stream (text, finish_reason) pairs for a single prompt.
 
-                except Exception as e:
-                    await stream_queue.put(e)
+        The prompt_tokens and completion_tokens entries of usage are kept up
+        to date. The scheduler reports exact completion counts; llama.cpp
+        streams one chunk per sampled token, plus a final one carrying the
+        finish reason.
+        """
+        try:
+            if self._scheduler is not None:
+                submission = await self._submit(prompt, params)
+                usage["prompt_tokens"] = len(submission.prompt_tokens)
+                async for text, finish_reason, n_generated in self._scheduled_events(
+                    submission
+                ):
+                    usage["completion_tokens"] = n_generated
+                    yield text, finish_reason
+                return
 
-            # Start the worker
-            worker_task = asyncio.create_task(stream_worker())
+            # Stream on the executor thread; chunks are handed to the loop
+            loop = asyncio.get_running_loop()
+            stream_queue: asyncio.Queue = asyncio.Queue()
+            stop_event = threading.Event()
+
+            prompt_tokens = list(await self._prompt_tokens(prompt))
+            usage["prompt_tokens"] = len(prompt_tokens)
+            generation_kwargs = {
+                **params,
+                "prompt": prompt_tokens,
+                "stream": True,
+            }
+            self._executor.submit(
+                _drain,
+                model,
+                generation_kwargs,
+                loop,
+                stream_queue,
+                stop_event,
+            )
 
             try:
                 while True:
                     chunk = await stream_queue.get()
 
-                    if chunk is None:  # End of stream
+                    if chunk is _SENTINEL:  # End of stream
                         break
 
                     if isinstance(chunk, Exception):
                         raise chunk
 
-                    # Format streaming chunk
                     choice = chunk["choices"][0]
-
-                    yield {
-                        "id": generation_id,
-                        "object": "text_completion",
-                        "created": created_time,
-                        "model": self.model_name,
-                        "choices": [
-                            {
-                                "text": choice["text"],
-                                "finish_reason": choice.get("finish_reason"),
-                                "index": 0,
-                            }
-                        ],
-                    }
+                    finish_reason = choice.get("finish_reason")
+                    if finish_reason is None:
+                        usage["completion_tokens"] += 1
+                    yield choice["text"], finish_reason
 
             finally:
-                # Clean up worker task
-                if not worker_task.done():
-                    worker_task.cancel()
-                    try:
-                        await worker_task
-                    except asyncio.CancelledError:
-                        pass
+                # Stop the producer if the consumer went away early
+                stop_event.set()
 
         except Exception as e:
             logger.error(f"Error in streaming generation: {e}")
@@ -363,14 +832,22 @@ class InferenceEngine:
 
     def get_model_info(self) -> Dict[str, Any]:
         """Get information about the loaded model"""
-        if not self.is_loaded:
+        model, model_name = self._state
+        if model is None:
             return {"loaded": False}
 
         return {
             "loaded": True,
             "model_path": self.settings.model_path,
-            "model_name": self.model_name,
+            "model_name": model_name,
+            "prompt_format": self.prompt_format.value,
             "n_ctx": self.settings.n_ctx,
             "n_gpu_layers": self.settings.n_gpu_layers,
+            "n_layer": self.n_layer,
             "n_batch": self.settings.n_batch,
+            "n_ubatch": self.settings.n_ubatch,
+            "flash_attn": self.settings.flash_attn,
+            "type_k": self.settings.type_k,
+            "type_v": self.settings.type_v,
+            "continuous_batching": self.continuous_batching,
         }
@@ -1,7 +1,40 @@
 from __future__ import annotations
 
+import copy
+import re
 from enum import Enum
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Literal template fragments, shared by every call
+_ALPACA_INSTRUCTION = "### Instruction:\n"
+_ALPACA_INPUT = "\n\n### Input:\n"
+_ALPACA_RESPONSE = "\n\n### Response:\n"
+_ALPACA_SEPARATOR = "\n\n"
+_ALPACA_CHAT_RESPONSE = "\n\n### Assistant:\n"
+_ALPACA_HEADERS = {
+    "system": "### System:\n",
+    "user": "### User:\n",
+    "assistant": "### Assistant:\n",
+}
+
+_CHATML_START = "<|im_start|>"
+_CHATML_END = "<|im_end|>\n"
+_CHATML_SYSTEM = "<|im_start|>system\n"
+_CHATML_USER = "<|im_start|>user\n"
+_CHATML_ASSISTANT = "<|im_start|>assistant\n"
+
+_PHI3_SYSTEM = "<|system|>\n"
+_PHI3_USER = "<|user|>\n"
+_PHI3_ASSISTANT = "<|assistant|>\n"
+_PHI3_END = "<|end|>\n"
+
+_LLAMA2_BOS = "<s>"
+_LLAMA2_INST = "[INST] "
+_LLAMA2_INST_SYS = "[INST] <<SYS>>\n"
+_LLAMA2_SYS_END = "\n<</SYS>>\n\n"
+_LLAMA2_INST_END = " [/INST]"
+_LLAMA2_TURN_END = " </s><s>"
 
 
 class PromptFormat(Enum):
@@ -30,6 +63,23 @@ class PromptTemplate:
         """Format a chat conversation"""
         raise NotImplementedError
 
+    # Text format_chat appends after the last message to cue the reply
+    chat_generation_prompt = ""
+
+    # Markers that rendered messages and the generation prompt start with,
+    # where a model's vocabulary may define them as special tokens
+    chat_special_prefixes: Tuple[str, ...] = ()
+
+    def format_chat_message(self, messages: Sequence[Dict[str, str]], i: int) -> str:
+        """
+        Render messages[i] the way format_chat does.
+
+        The result only depends on messages[: i + 1], so joining the
+        rendered messages and appending chat_generation_prompt gives
+        format_chat(messages).
+        """
+        raise NotImplementedError
+
 
 class AlpacaTemplate(PromptTemplate):
     """Alpaca prompt template"""
@@ -40,25 +90,46 @@ class AlpacaTemplate(PromptTemplate):
     def format_prompt(self, prompt: str, instruction: str = "", **kwargs) -> str:
         """Format prompt in Alpaca style"""
         if instruction:
-            return f"### Instruction:\n{instruction}\n\n### Input:\n{prompt}\n\n### Response:\n"
+            return "".join(
+                (
+                    _ALPACA_INSTRUCTION,
+                    instruction,
+                    _ALPACA_INPUT,
+                    prompt,
+                    _ALPACA_RESPONSE,
+                )
+            )
         else:
-            return f"### Instruction:\n{prompt}\n\n### Response:\n"
+            return "".join((_ALPACA_INSTRUCTION, prompt, _ALPACA_RESPONSE))
 
     def format_chat(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Format chat in Alpaca style"""
-        formatted_messages = []
+        parts: List[str] = []
         for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
+            role, content = msg.get("role", "user"), msg.get("content", "")
 
-            if role == "system":
-                formatted_messages.append(f"### System:\n{content}")
-            elif role == "user":
-                formatted_messages.append(f"### User:\n{content}")
-            elif role == "assistant":
-                formatted_messages.append(f"### Assistant:\n{content}")
+            header = _ALPACA_HEADERS.get(role)
+            if header is not None:
+                if parts:
+                    parts.append(_ALPACA_SEPARATOR)
+                parts.append(header)
+                parts.append(content)
+
+        parts.append(_ALPACA_CHAT_RESPONSE)
+        return "".join(parts)
 
-        return "\n\n".join(formatted_messages) + "\n\n### Assistant:\n"
+    chat_generation_prompt = _ALPACA_CHAT_RESPONSE
+
+    def format_chat_message(self, messages: Sequence[Dict[str, str]], i: int) -> str:
+        """Render one message in Alpaca style"""
+        header = _ALPACA_HEADERS.get(messages[i].get("role", "user"))
+        if header is None:
+            return ""
+        content = messages[i].get("content", "")
+        # Separated from the previous message that was rendered, if any
+        if any(m.get("role", "user") in _ALPACA_HEADERS for m in messages[:i]):
+            return "".join((_ALPACA_SEPARATOR, header, content))
+        return header + content
 
 
 class ChatMLTemplate(PromptTemplate):
@@ -69,21 +140,29 @@ class ChatMLTemplate(PromptTemplate):
 
     def format_prompt(self, prompt: str, system_message: str = "", **kwargs) -> str:
         """Format prompt in ChatML style"""
-        formatted = ""
+        parts: List[str] = []
         if system_message:
-            formatted += f"<|im_start|>system\n{system_message}<|im_end|>\n"
-        formatted += f"<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
-        return formatted
+            parts += (_CHATML_SYSTEM, system_message, _CHATML_END)
+        parts += (_CHATML_USER, prompt, _CHATML_END, _CHATML_ASSISTANT)
+        return "".join(parts)
 
     def format_chat(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Format chat in ChatML style"""
-        formatted = ""
+        parts: List[str] = []
         for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            formatted += f"<|im_start|>{role}\n{content}<|im_end|>\n"
-        formatted += "<|im_start|>assistant\n"
-        return formatted
+            role, content = msg.get("role", "user"), msg.get("content", "")
+            parts += (_CHATML_START, role, "\n", content, _CHATML_END)
+        parts.append(_CHATML_ASSISTANT)
+        return "".join(parts)
+
+    chat_generation_prompt = _CHATML_ASSISTANT
+    chat_special_prefixes = (_CHATML_START,)
+
+    def format_chat_message(self, messages: Sequence[Dict[str, str]], i: int) -> str:
+        """Render one message in ChatML style"""
+        msg = messages[i]
+        role, content = msg.get("role", "user"), msg.get("content", "")
+        return "".join((_CHATML_START, role, "\n", content, _CHATML_END))
 
 
 class Phi3Template(PromptTemplate):
@@ -94,21 +173,29 @@ class Phi3Template(PromptTemplate):
 
     def format_prompt(self, prompt: str, system_message: str = "", **kwargs) -> str:
         """Format prompt in Phi-3 style"""
-        formatted = ""
+        parts: List[str] = []
         if system_message:
-            formatted += f"<|system|>\n{system_message}<|end|>\n"
-        formatted += f"<|user|>\n{prompt}<|end|>\n<|assistant|>\n"
-        return formatted
+            parts += (_PHI3_SYSTEM, system_message, _PHI3_END)
+        parts += (_PHI3_USER, prompt, _PHI3_END, _PHI3_ASSISTANT)
+        return "".join(parts)
 
     def format_chat(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Format chat in Phi-3 style"""
-        formatted = ""
+        parts: List[str] = []
         for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            formatted += f"<|{role}|>\n{content}<|end|>\n"
-        formatted += "<|assistant|>\n"
-        return formatted
+            role, content = msg.get("role", "user"), msg.get("content", "")
+            parts += ("<|", role, "|>\n", content, _PHI3_END)
+        parts.append(_PHI3_ASSISTANT)
+        return "".join(parts)
+
+    chat_generation_prompt = _PHI3_ASSISTANT
+    chat_special_prefixes = ("<|system|>", "<|user|>", "<|assistant|>")
+
+    def format_chat_message(self, messages: Sequence[Dict[str, str]], i: int) -> str:
+        """Render one message in Phi-3 style"""
+        msg = messages[i]
+        role, content = msg.get("role", "user"), msg.get("content", "")
+        return "".join(("<|", role, "|>\n", content, _PHI3_END))
 
 
 class Llama2ChatTemplate(PromptTemplate):
@@ -120,13 +207,22 @@ class Llama2ChatTemplate(PromptTemplate):
     def format_prompt(self, prompt: str, system_message: str = "", **kwargs) -> str:
         """Format prompt in Llama 2 Chat style"""
         if system_message:
-            return f"<s>[INST] <<SYS>>\n{system_message}\n<</SYS>>\n\n{prompt} [/INST]"
+            return "".join(
+                (
+                    _LLAMA2_BOS,
+                    _LLAMA2_INST_SYS,
+                    system_message,
+                    _LLAMA2_SYS_END,
+                    prompt,
+                    _LLAMA2_INST_END,
+                )
+            )
         else:
-            return f"<s>[INST] {prompt} [/INST]"
+            return "".join((_LLAMA2_BOS, _LLAMA2_INST, prompt, _LLAMA2_INST_END))
 
     def format_chat(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Format chat in Llama 2 Chat style"""
-        formatted = "<s>"
+        parts: List[str] = [_LLAMA2_BOS]
         system_message = ""
 
         # Extract system message if present
@@ -135,18 +231,50 @@ class Llama2ChatTemplate(PromptTemplate):
             messages = messages[1:]
 
         for i, msg in enumerate(messages):
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
+            role, content = msg.get("role", "user"), msg.get("content", "")
 
             if role == "user":
                 if i == 0 and system_message:
-                    formatted += f"[INST] <<SYS>>\n{system_message}\n<</SYS>>\n\n{content} [/INST]"
+                    parts += (
+                        _LLAMA2_INST_SYS,
+                        system_message,
+                        _LLAMA2_SYS_END,
+                        content,
+                        _LLAMA2_INST_END,
+                    )
                 else:
-                    formatted += f"[INST] {content} [/INST]"
+                    parts += (_LLAMA2_INST, content, _LLAMA2_INST_END)
             elif role == "assistant":
-                formatted += f" {content} </s><s>"
-
-        return formatted
+                parts += (" ", content, _LLAMA2_TURN_END)
+
+        return "".join(parts)
+
+    def format_chat_message(self, messages: Sequence[Dict[str, str]], i: int) -> str:
+        """Render one message in Llama 2 Chat style"""
+        bos = _LLAMA2_BOS if i == 0 else ""
+        has_system = messages[0].get("role") == "system"
+        if i == 0 and has_system:
+            # Folded into the first user turn
+            return bos
+
+        msg = messages[i]
+        role, content = msg.get("role", "user"), msg.get("content", "")
+        if role == "user":
+            system_message = messages[0].get("content", "") if has_system else ""
+            if i == 1 and system_message:
+                return "".join(
+                    (
+                        _LLAMA2_INST_SYS,
+                        system_message,
+                        _LLAMA2_SYS_END,
+                        content,
+                        _LLAMA2_INST_END,
+                    )
+                )
+            return "".join((bos, _LLAMA2_INST, content, _LLAMA2_INST_END))
+        if role == "assistant":
+            return "".join((bos, " ", content, _LLAMA2_TURN_END))
+        return bos
 
 
 class PlainTemplate(PromptTemplate):
@@ -168,6 +296,15 @@ class PlainTemplate(PromptTemplate):
             formatted_messages.append(f"{role.capitalize()}: {content}")
         return "\n".join(formatted_messages) + "\nAssistant:"
 
+    chat_generation_prompt = "\nAssistant:"
+
+    def format_chat_message(self, messages: Sequence[Dict[str, str]], i: int) -> str:
+        """Render one message as plain text"""
+        msg = messages[i]
+        role, content = msg.get("role", "user"), msg.get("content", "")
+        separator = "\n" if i else ""
+        return f"{separator}{role.capitalize()}: {content}"
+
 
 class PromptTemplateManager:
     """Manager for prompt templates"""
@@ -187,21 +324,7 @@ class PromptTemplateManager:
 
     def detect_format(self, model_name: str) -> PromptFormat:
         """Detect prompt format based on model name"""
-        model_name_lower = model_name.lower()
-
-        if "phi-3" in model_name_lower or "phi3" in model_name_lower:
-            return PromptFormat.PHI3
-        elif "llama-2" in model_name_lower or "llama2" in model_name_lower:
-            if "chat" in model_name_lower:
-                return PromptFormat.LLAMA2_CHAT
-        elif "alpaca" in model_name_lower:
-            return PromptFormat.ALPACA
-        elif "chatml" in model_name_lower:
-            return PromptFormat.CHATML
-        elif "mistral" in model_name_lower:
-            return PromptFormat.CHATML  # Mistral often uses ChatML
-
-        return PromptFormat.PLAIN
+        return _detect_format(model_name)
 
     def format_prompt(
         self,
@@ -236,6 +359,130 @@ class PromptTemplateManager:
         return template.format_chat(messages, **kwargs)
 
 
+class TokenizedChatBuilder:
+    """
+    Chat prompt that is tokenized one message at a time.
+
+    Each message is rendered with format_chat_message and tokenized once
+    when it is added, so the prompt for the next turn is the cached token
+    ids of every earlier message plus the generation prompt instead of a
+    re-rendered, re-tokenized conversation.
+
+    That is only exact while every fragment starts with a special token:
+    tokenizers cannot merge across one, and SentencePiece vocabularies
+    prefix a space to raw text at the start of the input either way. A
+    fragment starting with raw text would gain a stray space token when
+    tokenized alone, so once one is added the builder falls back to
+    tokenizing the whole format_chat string.
+    """
+
+    def __init__(
+        self,
+        template: PromptTemplate,
+        tokenize: Callable[[str], List[int]],
+        prefix: Sequence[int] = (),
+        special_prefixes: Sequence[str] = (),
+    ):
+        """
+        Args:
+            template: Template used to render each message
+            tokenize: Tokenizes a fragment without adding BOS
+            prefix: Token ids placed before the first message, e.g. BOS
+            special_prefixes: Entries of template.chat_special_prefixes that
+                the tokenizer treats as single special tokens
+        """
+        self.template = template
+        self._tokenize = tokenize
+        self._prefix = list(prefix)
+        self._special_prefixes = tuple(special_prefixes)
+        self.messages: List[Dict[str, str]] = []
+        self._tokens: List[int] = list(prefix)
+        self._prompt: Optional[List[int]] = None
+        # str.startswith is False for an empty tuple of prefixes
+        self._per_message = template.chat_generation_prompt.startswith(
+            self._special_prefixes
+        )
+        self._generation_prompt = (
+            tokenize(template.chat_generation_prompt) if self._per_message else []
+        )
+
+    def add_message(self, role: str, content: str):
+        """
+        Append a message and tokenize its rendered form.
+
+        Args:
+            role: Message role (system, user or assistant)
+            content: Message text
+        """
+        self.messages.append({"role": role, "content": content})
+        self._prompt = None
+        if not self._per_message:
+            return
+
+        fragment = self.template.format_chat_message(
+            self.messages, len(self.messages) - 1
+        )
+        if not fragment.startswith(self._special_prefixes):
+            self._per_message = False
+            self._tokens = self._generation_prompt = []
+            return
+        self._tokens += self._tokenize(fragment)
+
+    def prompt_tokens(self) -> List[int]:
+        """
+        Token ids of the conversation followed by the generation prompt.
+
+        The result is kept until the next message is added, so repeated calls
+        do not tokenize again.
+
+        Returns:
+            Prompt token ids for the assistant's next reply
+        """
+        if self._prompt is None:
+            if self._per_message:
+                self._prompt = self._tokens + self._generation_prompt
+            else:
+                text = self.template.format_chat(self.messages)
+                self._prompt = self._prefix + self._tokenize(text)
+        return list(self._prompt)
+
+    def copy(self) -> TokenizedChatBuilder:
+        """Builder for the same conversation that can be extended separately"""
+        other = copy.copy(self)
+        other.messages = list(self.messages)
+        other._tokens = list(self._tokens)
+        return other
+
+
+# Alternatives are tried in order, so earlier ones take precedence
+# regardless of where they appear in the model name
+_FORMAT_RE = re.compile(
+    r"^(?:"
+    r"(?=.*phi-?3)(?P<phi3>)"
+    r"|(?=.*llama-?2)(?=.*chat)(?P<llama2_chat>)"
+    r"|(?=.*llama-?2)(?P<llama2>)"
+    r"|(?=.*alpaca)(?P<alpaca>)"
+    r"|(?=.*(?:chatml|mistral))(?P<chatml>)"  # Mistral often uses ChatML
+    r")",
+    re.IGNORECASE | re.DOTALL,
+)
+
+_FORMAT_GROUPS: Dict[str, PromptFormat] = {
+    "phi3": PromptFormat.PHI3,
+    "llama2_chat": PromptFormat.LLAMA2_CHAT,
+    "llama2": PromptFormat.PLAIN,
+    "alpaca": PromptFormat.ALPACA,
+    "chatml": PromptFormat.CHATML,
+}
+
+
+@lru_cache(maxsize=64)
+def _detect_format(model_name: str) -> PromptFormat:
+    """Map a model name to its prompt format with a single regex match"""
+    match = _FORMAT_RE.match(model_name)
+    return _FORMAT_GROUPS[match.lastgroup] if match else PromptFormat.PLAIN
+
+
 # Global instance
 prompt_manager = PromptTemplateManager()
 
@@ -0,0 +1,198 @@
+"""
+Continuous batching scheduler for the batch decoder.
+
+A single background task owns the BatchDecoder. Between decode steps it
+admits newly submitted requests into the running batch, so requests join
+and leave the batch independently instead of waiting for a whole batch
+to finish.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from .batch_decoder import BatchDecoder
+
+logger = logging.getLogger(__name__)
+
+# (text, finish_reason, completion_tokens) or the error that ended the request
+SchedulerEvent = Union[Tuple[str, Optional[str], int], Exception]
+
+
+class Submission:
+    """A request submitted to the scheduler and the queue its output goes to"""
+
+    __slots__ = ("prompt_tokens", "params", "out", "cancelled")
+
+    def __init__(self, prompt_tokens: Sequence[int], params: Dict):
+        self.prompt_tokens = prompt_tokens
+        self.params = params
+        self.out: asyncio.Queue[SchedulerEvent] = asyncio.Queue()
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop generating for this request at the next step"""
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Feed a rolling batch of requests to a BatchDecoder.
+
+    Requests are admitted in submission order as soon as the decoder has a
+    free sequence slot and enough KV cache. Every step's output is pushed
+    to the owning request's queue; a request ends with an event whose
+    finish_reason is set, or with an exception.
+    """
+
+    def __init__(self, decoder: BatchDecoder, executor: concurrent.futures.Executor):
+        self._decoder = decoder
+        self._executor = executor
+        self._queue: asyncio.Queue[Optional[Submission]] = asyncio.Queue()
+        self._waiting: Deque[Optional[Submission]] = deque()
+        self._running: Dict[int, Submission] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        """Start the scheduling loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Continuous batching scheduler started")
+
+    async def stop(self):
+        """Stop the scheduling loop and fail every outstanding request"""
+        if self._task is not None:
+            # Let an in-flight step finish rather than freeing the decoder
+            # under it, then wake the loop if it is idle
+            self._stopping = True
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+        error = RuntimeError("Scheduler stopped")
+        self._fail_running(error)
+        while not self._queue.empty():
+            self._waiting.append(self._queue.get_nowait())
+        while self._waiting:
+            submission = self._waiting.popleft()
+            if submission is not None:
+                submission.out.put_nowait(error)
+
+        logger.info("Continuous batching scheduler stopped")
+
+    def submit(
+        self,
+        prompt_tokens: Sequence[int],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repeat_penalty: float,
+        stop: Optional[Sequence[str]] = None,
+        seed: Optional[int] = None,
+    ) -> Submission:
+        """
+        Queue a request for generation.
+
+        Args:
+            prompt_tokens: Tokenized prompt
+            max_tokens: Maximum tokens to generate
+            temperature: Sampling temperature
+            top_p: Top-p nucleus sampling
+            top_k: Top-k sampling
+            repeat_penalty: Repetition penalty
+            stop: Stop sequences
+            seed: Random seed for reproducibility
+
+        Returns:
+            Submission whose out queue receives the generated events
+        """
+        submission = Submission(
+            prompt_tokens,
+            {
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "top_k": top_k,
+                "repeat_penalty": repeat_penalty,
+                "stop": stop,
+                "seed": seed,
+            },
+        )
+        self._queue.put_nowait(submission)
+        return submission
+
+    async def _run(self):
+        """Admit, decode and dispatch until stopped"""
+        loop = asyncio.get_running_loop()
+
+        while not self._stopping:
+            if not self._running and not self._waiting:
+                self._waiting.append(await self._queue.get())
+            while not self._queue.empty():
+                self._waiting.append(self._queue.get_nowait())
+            if self._stopping:
+                break
+
+            self._evict_cancelled()
+            self._admit()
+            if not self._running:
+                continue
+
+            try:
+                events = await loop.run_in_executor(self._executor, self._decoder.step)
+            except Exception as e:
+                logger.error(f"Error in batched decode: {e}")
+                self._fail_running(e)
+                continue
+
+            for seq_id, text, finish_reason, n_generated in events:
+                submission = self._running[seq_id]
+                submission.out.put_nowait((text, finish_reason, n_generated))
+                if finish_reason is not None:
+                    del self._running[seq_id]
+
+    def _admit(self):
+        """Move waiting requests into the batch while the decoder has room"""
+        decoder = self._decoder
+        while self._waiting:
+            submission = self._waiting[0]
+            if submission is None or submission.cancelled:
+                self._waiting.popleft()
+                continue
+
+            budget = len(submission.prompt_tokens) + submission.params["max_tokens"]
+            if not decoder.fits(budget):
+                self._waiting.popleft()
+                submission.out.put_nowait(
+                    ValueError("Prompt does not fit in the context")
+                )
+                continue
+            if not decoder.can_admit(budget):
+                break
+
+            self._waiting.popleft()
+            seq_id = decoder.add(submission.prompt_tokens, **submission.params)
+            self._running[seq_id] = submission
+
+    def _evict_cancelled(self):
+        """Drop running requests whose consumer has gone away"""
+        cancelled: List[int] = [
+            seq_id for seq_id, sub in self._running.items() if sub.cancelled
+        ]
+        for seq_id in cancelled:
+            self._decoder.remove(seq_id)
+            del self._running[seq_id]
+
+    def _fail_running(self, error: Exception):
+        """Fail and release every running request"""
+        for seq_id, submission in self._running.items():
+            self._decoder.remove(seq_id)
+            submission.out.put_nowait(error)
+        self._running.clear()
@@ -4,6 +4,8 @@ This module provides a cool, informative banner for the server startup.
 
 from __future__ import annotations
 
+from typing import Callable, List, Optional, Tuple
+
 from rich.console import Console
 from rich.panel import Panel
 from rich.table import Table
@@ -11,14 +13,8 @@ from rich.text import Text
 
 from .config import Settings
 
-
-def print_banner(console: Console, settings: Settings):
-    """
-    Prints a banner to the console.
-    """
-
-    # ASCII Art for the title
-    title_art = r"""
+# ASCII Art for the title
+_TITLE_ART = r"""
 ██╗     ██╗     ███╗   ███╗███████╗███████╗██████╗ ██╗   ██╗███████╗██╗   ██╗
 ██║     ██║     ████╗ ████║██╔════╝██╔════╝██╔══██╗██║   ██║██╔════╝██║   ██║
 ██║     ██║     ██╔████╔██║███████╗█████╗  ██████╔╝██║   ██║█████╗  ██║   ██║
@@ -27,21 +23,67 @@ def print_banner(console: Console, settings: Settings):
 ╚══════╝╚══════╝╚═╝     ╚═╝╚══════╝╚══════╝╚═╝  ╚═╝ ╚═════╝ ╚══════╝  ╚═══╝
     """
 
-    console.print(Text(title_art, style="bold blue"), justify="center")
+_TITLE = Text(_TITLE_ART, style="bold blue")
+
+
+def _gpu_layers(settings: Settings, n_layer: Optional[int]) -> str:
+    """GPU layer count, flagged in red when only part of the model is offloaded"""
+    if n_layer is not None and 0 <= settings.n_gpu_layers < n_layer:
+        return (
+            f"[bold red]{settings.n_gpu_layers} / {n_layer} "
+            "(partial offload)[/bold red]"
+        )
+    return f"[green]{settings.n_gpu_layers}[/green]"
+
+
+def _server_url(settings: Settings, n_layer: Optional[int]) -> str:
+    """Clickable server URL"""
+    url = f"http://{settings.server_host}:{settings.server_port}"
+    return f"[link={url}]{url}[/link]"
+
+
+# (label, cell) rows of the configuration table
+_ROWS: List[Tuple[str, Callable[[Settings, Optional[int]], str]]] = [
+    ("Model Path :", lambda s, n: f"[italic]{s.model_path}[/italic]"),
+    ("GPU Layers :", _gpu_layers),
+    ("Context Size :", lambda s, n: f"[yellow]{s.n_ctx}[/yellow]"),
+    (
+        "Threads :",
+        lambda s, n: f"[magenta]{s.n_threads} / {s.n_threads_batch}[/magenta] "
+        "(generation / prompt)",
+    ),
+    ("Batch Size :", lambda s, n: f"[magenta]{s.max_batch_size}[/magenta]"),
+    (
+        "Prefill Batch :",
+        lambda s, n: f"[magenta]{s.n_batch} / {s.n_ubatch}[/magenta] (logical / micro)",
+    ),
+    (
+        "Flash Attention :",
+        lambda s, n: "[green]on[/green]" if s.flash_attn else "[yellow]off[/yellow]",
+    ),
+    ("KV Cache Type :", lambda s, n: f"[yellow]{s.type_k} / {s.type_v}[/yellow]"),
+    ("Server URL :", _server_url),
+]
+
+
+def print_banner(console: Console, settings: Settings, n_layer: Optional[int] = None):
+    """
+    Prints a banner to the console.
+
+    Args:
+        console: Console to print to
+        settings: Application settings
+        n_layer: Layer count of the loaded model, used to flag partial GPU offload
+    """
+    console.print(_TITLE, justify="center")
 
     # Configuration Table
     grid = Table.grid(expand=True, padding=(0, 2))
     grid.add_column(justify="right", style="bold cyan")
     grid.add_column(justify="left", style="white")
 
-    grid.add_row("Model Path :", f"[italic]{settings.model_path}[/italic]")
-    grid.add_row("GPU Layers :", f"[green]{settings.n_gpu_layers}[/green]")
-    grid.add_row("Context Size :", f"[yellow]{settings.n_ctx}[/yellow]")
-    grid.add_row("Batch Size :", f"[magenta]{settings.max_batch_size}[/magenta]")
-    grid.add_row(
-        "Server URL :",
-        f"[link=http://{settings.server_host}:{settings.server_port}]http://{settings.server_host}:{settings.server_port}[/link]",
-    )
+    for label, cell in _ROWS:
+        grid.add_row(label, cell(settings, n_layer))
 
     panel = Panel(
         grid,
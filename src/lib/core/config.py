@@ -4,11 +4,15 @@ from __future__ import annotations
 
 import os
 from functools import lru_cache
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import Field
+from pydantic import Field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from .cpu import performance_core_count
+
+KVCacheType = Literal["f32", "f16", "q8_0", "q5_1", "q5_0", "q4_1", "q4_0"]
+
 
 class Settings(BaseSettings):
     """Application settings loaded from environment variables"""
@@ -29,12 +33,36 @@ class Settings(BaseSettings):
 
     # llama-cpp-python Configuration
     n_gpu_layers: int = Field(
-        default=32, description="Number of layers to offload to GPU (-1 for all)"
+        default=-1, description="Number of layers to offload to GPU (-1 for all)"
     )
     n_ctx: int = Field(default=4096, description="Context window size")
-    n_batch: int = Field(default=512, description="Batch size for prompt processing")
+    n_batch: int = Field(
+        default=2048, description="Logical batch size for prompt processing"
+    )
+    n_ubatch: int = Field(
+        default=512, description="Physical micro-batch size for prompt processing"
+    )
     n_threads: Optional[int] = Field(
-        default=None, description="Number of threads (None for auto-detect)"
+        default_factory=performance_core_count,
+        description="Threads used for generation (defaults to the performance cores)",
+    )
+    n_threads_batch: Optional[int] = Field(
+        default=None,
+        description="Threads used for prompt processing (defaults to n_threads)",
+    )
+    pin_threads: bool = Field(
+        default=True,
+        description="Keep the llama.cpp threads on the performance cores",
+    )
+    flash_attn: bool = Field(
+        default=True, description="Use flash attention kernels where supported"
+    )
+    type_k: KVCacheType = Field(
+        default="q8_0", description="Data type of the KV cache keys"
+    )
+    type_v: KVCacheType = Field(
+        default="q8_0",
+        description="Data type of the KV cache values (quantized types need flash_attn)",
     )
     use_mlock: bool = Field(
         default=True, description="Use mlock to prevent model from being swapped"
@@ -42,6 +70,14 @@ class Settings(BaseSettings):
     use_mmap: bool = Field(
         default=True, description="Use memory mapping for model loading"
     )
+    prompt_cache_bytes: int = Field(
+        default=0,
+        description="RAM prompt cache size in bytes for prefix KV reuse (0 disables)",
+    )
+    prompt_cache_prewarm: str = Field(
+        default="",
+        description="Shared prompt prefix evaluated at startup to warm the cache",
+    )
 
     # Dynamic Batching Configuration
     max_batch_size: int = Field(
@@ -50,6 +86,26 @@ class Settings(BaseSettings):
     batch_timeout: float = Field(
         default=0.1, description="Maximum time to wait for batch formation (seconds)"
     )
+    preferred_batch_size: int = Field(
+        default=4,
+        description="Queue length at which a batch is flushed without waiting",
+    )
+    max_batch_concurrency: int = Field(
+        default=1,
+        description="Number of batches that may run on the engine concurrently",
+    )
+    default_slo_ms: int = Field(
+        default=30000,
+        description="Deadline used to order requests that do not set deadline_ms",
+    )
+    ema_arrival_rate: float = Field(
+        default=0.2,
+        description="Smoothing factor for the inter-arrival time moving average",
+    )
+    enable_continuous_batching: bool = Field(
+        default=False,
+        description="Decode batched prompts together in one llama.cpp batch",
+    )
 
     # Generation Defaults
     default_max_tokens: int = Field(
@@ -71,6 +127,13 @@ class Settings(BaseSettings):
     # CLI Configuration
     app_name: str = Field(default="LLM Server Chat", description="CLI application name")
 
+    @model_validator(mode="after")
+    def _default_n_threads_batch(self) -> Settings:
+        """Use n_threads for prompt processing unless set separately"""
+        if self.n_threads_batch is None:
+            self.n_threads_batch = self.n_threads
+        return self
+
     def validate_model_path(self) -> bool:
         """Validate that the model path exists"""
         return os.path.exists(self.model_path)
@@ -80,10 +143,20 @@ class Settings(BaseSettings):
         """Check if model file exists"""
         return self.validate_model_path()
 
+    @property
+    def api_url(self) -> str:
+        """Construct the base URL of the v1 API"""
+        return f"http://{self.server_host}:{self.server_port}/api/v1"
+
     @property
     def server_url(self) -> str:
         """Construct the full server URL"""
-        return f"http://{self.server_host}:{self.server_port}/api/v1/generate"
+        return f"{self.api_url}/generate"
+
+    @property
+    def chat_stream_url(self) -> str:
+        """Construct the URL of the chat streaming endpoint"""
+        return f"{self.api_url}/chat/stream"
 
 
 @lru_cache()
@@ -0,0 +1,131 @@
+"""CPU topology helpers for sizing and placing the llama.cpp threads"""
+
+from __future__ import annotations
+
+import ctypes
+import logging
+import os
+import subprocess
+import sys
+from functools import lru_cache
+from typing import FrozenSet, Optional
+
+logger = logging.getLogger(__name__)
+
+# qos_class_t value from <sys/qos.h>
+_QOS_CLASS_USER_INTERACTIVE = 0x21
+
+
+def _parse_cpu_list(text: str) -> FrozenSet[int]:
+    """Parse a Linux CPU list such as "0-7,16-23" """
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return frozenset(cpus)
+
+
+def _read(path: str) -> Optional[str]:
+    """Read a sysfs file, or None if it does not exist"""
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _linux_performance_cpus(allowed: FrozenSet[int]) -> FrozenSet[int]:
+    """Performance CPUs of a hybrid Linux machine, or every allowed CPU"""
+    # Intel hybrid parts list their P-cores here
+    core_cpus = _read("/sys/devices/cpu_core/cpus")
+    if core_cpus:
+        cpus = _parse_cpu_list(core_cpus) & allowed
+        if cpus:
+            return cpus
+
+    # Arm big.LITTLE parts report a relative capacity per CPU
+    capacities = {}
+    for cpu in allowed:
+        capacity = _read(f"/sys/devices/system/cpu/cpu{cpu}/cpu_capacity")
+        if capacity is None:
+            return allowed
+        capacities[cpu] = int(capacity)
+    top = max(capacities.values())
+    return frozenset(cpu for cpu, c in capacities.items() if c == top)
+
+
+def _macos_performance_cores() -> Optional[int]:
+    """Logical CPU count of the performance cluster on Apple silicon"""
+    try:
+        out = subprocess.run(
+            ["sysctl", "-n", "hw.perflevel0.logicalcpu"],
+            capture_output=True,
+            text=True,
+            timeout=2,
+            check=True,
+        ).stdout
+        return int(out) or None
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+@lru_cache()
+def performance_cpus() -> Optional[FrozenSet[int]]:
+    """
+    CPU ids of the performance cores this process may run on.
+
+    Returns:
+        The CPU set on Linux, or None where threads cannot be pinned
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    allowed = frozenset(os.sched_getaffinity(0))
+    if sys.platform.startswith("linux"):
+        return _linux_performance_cpus(allowed)
+    return allowed
+
+
+@lru_cache()
+def performance_core_count() -> int:
+    """
+    Number of threads llama.cpp should use.
+
+    Apple silicon reports its performance cores through sysctl; on Linux
+    the performance CPUs of hybrid parts are counted. Elsewhere every
+    available CPU is used.
+    """
+    if sys.platform == "darwin":
+        cores = _macos_performance_cores()
+        if cores:
+            return cores
+
+    cpus = performance_cpus()
+    if cpus:
+        return len(cpus)
+    return os.cpu_count() or 8
+
+
+def pin_to_performance_cores():
+    """
+    Keep the calling thread on the performance cores.
+
+    On Linux the thread's affinity is restricted to the performance CPUs.
+    macOS has no affinity API, so the thread is given the user-interactive
+    QoS class, which the scheduler places on the performance cluster.
+    Failures are logged and otherwise ignored.
+    """
+    try:
+        if sys.platform == "darwin":
+            libc = ctypes.CDLL("/usr/lib/libSystem.dylib")
+            rc = libc.pthread_set_qos_class_self_np(_QOS_CLASS_USER_INTERACTIVE, 0)
+            if rc != 0:
+                raise OSError(rc, "pthread_set_qos_class_self_np failed")
+        elif sys.platform.startswith("linux"):
+            cpus = performance_cpus()
+            if cpus:
+                # pid 0 applies to the calling thread only
+                os.sched_setaffinity(0, cpus)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not pin llama.cpp thread to performance cores: {e}")
@@ -0,0 +1,27 @@
+"""Prometheus metrics for the inference service"""
+
+from __future__ import annotations
+
+from prometheus_client import Counter, Gauge, Histogram
+
+REQUESTS = Counter("inf_requests_total", "Generation requests received")
+
+QUEUE_DEPTH = Gauge("inf_queue_depth", "Requests waiting to be batched")
+
+QUEUE_WAIT = Histogram(
+    "inf_queue_wait_seconds",
+    "Time requests spend queued before their batch is processed",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+
+BATCH_SIZE = Histogram(
+    "inf_batch_size",
+    "Number of requests per processed batch",
+    buckets=(1, 2, 4, 8, 16, 32),
+)
+
+TOKENS = Counter(
+    "inf_tokens_total",
+    "Tokens processed, by kind (prompt or completion)",
+    labelnames=("kind",),
+)
@@ -0,0 +1,178 @@
+"""Tests for request batching, deduplication and scheduling in the service"""
+
+import asyncio
+
+import pytest
+
+from src.app.schemas.request import GenerationRequest
+from src.app.services.inference_service import InferenceService, _dedup_key
+
+
+class _FakeEngine:
+    """
+    Engine that upper-cases each prompt and records every batch it gets.
+
+    A "boom" prompt raises mid-batch and a "lost" prompt gets no response.
+    """
+
+    is_loaded = True
+    continuous_batching = False
+
+    def __init__(self):
+        self.calls = []
+
+    async def generate_batch_streaming(self, prompts, **params):
+        self.calls.append(list(prompts))
+        for i, prompt in enumerate(prompts):
+            await asyncio.sleep(0)
+            if prompt == "boom":
+                raise RuntimeError("boom")
+            if prompt == "lost":
+                continue
+            yield i, {
+                "choices": [{"text": prompt.upper(), "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": 1,
+                    "completion_tokens": 1,
+                    "total_tokens": 2,
+                },
+            }
+
+
+def _service() -> InferenceService:
+    service = InferenceService()
+    service.engine = _FakeEngine()
+    service.is_running = True
+    return service
+
+
+def _request(prompt: str, **kwargs) -> GenerationRequest:
+    return GenerationRequest(prompt=prompt, temperature=0.0, **kwargs)
+
+
+async def _serve(service: InferenceService, requests):
+    """Queue every request, then run one batch processor until all finish"""
+    tasks = [asyncio.ensure_future(service.generate(r)) for r in requests]
+    # Let every request reach the queue before the first batch is collected
+    await asyncio.sleep(0)
+    processor = asyncio.create_task(service._batch_processor())
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        processor.cancel()
+        await asyncio.gather(processor, return_exceptions=True)
+
+
+def _texts(results):
+    return [
+        r["choices"][0]["text"] if isinstance(r, dict) else type(r).__name__
+        for r in results
+    ]
+
+
+def test_duplicates_share_one_generation_and_pooled_requests_are_reused():
+    service = _service()
+
+    async def run():
+        results = await _serve(
+            service, [_request("a"), _request("a"), _request("b"), _request("a")]
+        )
+        assert _texts(results) == ["A", "A", "B", "A"]
+        assert service.engine.calls == [["a", "b"]]
+
+        # Only the two generated requests went through the pool, and pooled
+        # objects hold no references to finished requests
+        assert len(service._br_pool) == 2
+        for batch_request in service._br_pool:
+            assert batch_request.request is None
+            assert batch_request.future is None
+            assert batch_request.dedup_key is None
+        assert service._inflight == {}
+
+        # A second round reuses the pooled objects without leaking state
+        pooled = set(map(id, service._br_pool))
+        results = await _serve(service, [_request("c"), _request("c")])
+        assert _texts(results) == ["C", "C"]
+        assert service.engine.calls[-1] == ["c"]
+        assert set(map(id, service._br_pool)) <= pooled
+        assert service._inflight == {}
+
+    asyncio.run(run())
+
+
+def test_dedup_key_skips_stochastic_and_deadline_requests():
+    assert _dedup_key(_request("a")) is not None
+    assert _dedup_key(GenerationRequest(prompt="a", temperature=0.7)) is None
+    assert _dedup_key(GenerationRequest(prompt="a", temperature=0.7, seed=1))
+    assert _dedup_key(_request("a", deadline_ms=1000)) is None
+    assert _dedup_key(_request("a", priority=1)) != _dedup_key(_request("a"))
+
+
+def test_queue_is_drained_by_priority_then_deadline():
+    service = _service()
+
+    async def run():
+        requests = [
+            _request("p5", priority=5),
+            _request("p1-late", priority=1, deadline_ms=60_000),
+            _request("p0", priority=0),
+            _request("p1-soon", priority=1, deadline_ms=1_000),
+        ]
+        tasks = [asyncio.ensure_future(service.generate(r)) for r in requests]
+        await asyncio.sleep(0)
+
+        batch = []
+        service._drain_queue(batch)
+        assert [b.request.prompt for b in batch] == ["p0", "p1-soon", "p1-late", "p5"]
+        assert service.approx_qsize == 0
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_expired_requests_fail_instead_of_running():
+    service = _service()
+
+    async def run():
+        expired = asyncio.ensure_future(service.generate(_request("x", deadline_ms=1)))
+        await asyncio.sleep(0.01)
+
+        batch = []
+        service._drain_queue(batch)
+        assert batch == []
+        with pytest.raises(TimeoutError):
+            await expired
+        assert len(service._br_pool) == 1
+
+    asyncio.run(run())
+
+
+def test_group_failure_only_fails_requests_without_a_response():
+    service = _service()
+
+    async def run():
+        results = await _serve(
+            service,
+            [_request("a"), _request("lost"), _request("boom"), _request("d")],
+        )
+        # "a" finished before the engine raised; "lost" and "d" were pending
+        assert _texts(results) == ["A", "RuntimeError", "RuntimeError", "RuntimeError"]
+        assert str(results[2]) == "boom"
+        assert service._inflight == {}
+        assert len(service._br_pool) == 4
+
+    asyncio.run(run())
+
+
+def test_missing_responses_fail_with_an_error():
+    service = _service()
+
+    async def run():
+        results = await _serve(service, [_request("a"), _request("lost")])
+        assert _texts(results) == ["A", "RuntimeError"]
+        assert "No response" in str(results[1])
+
+    asyncio.run(run())
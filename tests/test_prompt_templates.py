@@ -0,0 +1,183 @@
+"""Tests for per-message chat rendering and the tokenized chat builder"""
+
+import asyncio
+import random
+import re
+
+import pytest
+
+from src.inference.engine import InferenceEngine
+from src.inference.prompt_templates import (
+    PromptFormat,
+    TokenizedChatBuilder,
+    prompt_manager,
+)
+from src.lib.core.config import Settings
+
+ROLES = ["system", "user", "assistant", "tool"]
+TEMPLATES = list(prompt_manager.templates.values())
+
+# Markers the templates use, as a vocabulary might define them
+SPECIAL_TOKENS = (
+    "<|im_start|>",
+    "<|im_end|>",
+    "<|system|>",
+    "<|user|>",
+    "<|assistant|>",
+    "<|end|>",
+)
+_SPECIAL_RE = re.compile("(" + "|".join(map(re.escape, SPECIAL_TOKENS)) + ")")
+
+
+def _random_messages(rng: random.Random, n: int):
+    """Conversation of n messages, some missing their role or content"""
+    messages = []
+    for _ in range(n):
+        message = {}
+        if rng.random() < 0.9:
+            message["role"] = rng.choice(ROLES)
+        if rng.random() < 0.9:
+            message["content"] = rng.choice(["", "hi", "two\nlines", " padded "])
+        messages.append(message)
+    return messages
+
+
+def _spm_tokenize(text: str, specials=SPECIAL_TOKENS):
+    """
+    One token per character, with special tokens split out first.
+
+    Like llama.cpp with a SentencePiece vocabulary, a space is prefixed to
+    raw text at the start of the input and after every special token.
+    """
+    tokens = []
+    prev_special = True
+    for part in _SPECIAL_RE.split(text) if specials else [text]:
+        if part in specials:
+            tokens.append(-1 - specials.index(part))
+            prev_special = True
+        elif part:
+            tokens += [ord(c) for c in (" " + part if prev_special else part)]
+            prev_special = False
+    return tokens
+
+
+@pytest.mark.parametrize("template", TEMPLATES, ids=lambda t: t.format_type.value)
+def test_format_chat_message_joins_to_format_chat(template):
+    rng = random.Random(0)
+    for _ in range(500):
+        messages = _random_messages(rng, rng.randint(1, 7))
+        rendered = "".join(
+            template.format_chat_message(messages, i) for i in range(len(messages))
+        )
+        assert rendered + template.chat_generation_prompt == template.format_chat(
+            messages
+        )
+
+
+@pytest.mark.parametrize("specials", [SPECIAL_TOKENS, ()], ids=["special", "plain"])
+@pytest.mark.parametrize("template", TEMPLATES, ids=lambda t: t.format_type.value)
+def test_builder_matches_whole_tokenization(template, specials):
+    rng = random.Random(1)
+
+    def tokenize(text):
+        return _spm_tokenize(text, specials)
+
+    special_prefixes = [p for p in template.chat_special_prefixes if p in specials]
+    for _ in range(100):
+        messages = _random_messages(rng, rng.randint(1, 7))
+        builder = TokenizedChatBuilder(
+            template, tokenize, prefix=[0], special_prefixes=special_prefixes
+        )
+        for message in messages:
+            builder.add_message(message.get("role", "user"), message.get("content", ""))
+        expected = [0] + tokenize(template.format_chat(builder.messages))
+        assert builder.prompt_tokens() == expected
+
+
+def test_builder_copy_is_independent():
+    template = prompt_manager.get_template(PromptFormat.CHATML)
+    builder = TokenizedChatBuilder(
+        template, _spm_tokenize, special_prefixes=template.chat_special_prefixes
+    )
+    builder.add_message("user", "hi")
+    before = builder.prompt_tokens()
+
+    other = builder.copy()
+    other.add_message("assistant", "hello")
+
+    assert builder.prompt_tokens() == before
+    assert len(builder.messages) == 1
+    assert len(other.messages) == 2
+
+
+class _FakeModel:
+    """SentencePiece-like tokenizer that records every text it tokenizes"""
+
+    def __init__(self):
+        self.calls = []
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        text = text.decode("utf-8")
+        self.calls.append(text)
+        tokens = _spm_tokenize(text, SPECIAL_TOKENS if special else ())
+        return ([1] if add_bos else []) + tokens
+
+
+def test_chat_prompt_tokens_reuses_earlier_turns():
+    engine = InferenceEngine(Settings())
+    model = _FakeModel()
+    engine._state = (model, "test-chatml")
+    engine.prompt_format = PromptFormat.CHATML
+    template = prompt_manager.get_template(PromptFormat.CHATML)
+
+    first = [
+        {"role": "system", "content": "be brief"},
+        {"role": "user", "content": "hi"},
+    ]
+    second = first + [
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "bye"},
+    ]
+
+    async def run():
+        tokens = await engine.chat_prompt_tokens(first)
+        assert tokens == [1] + _spm_tokenize(template.format_chat(first))
+
+        model.calls.clear()
+        tokens = await engine.chat_prompt_tokens(second)
+        assert tokens == [1] + _spm_tokenize(template.format_chat(second))
+        # Only the two new messages were tokenized
+        assert model.calls == [
+            template.format_chat_message(second, 2),
+            template.format_chat_message(second, 3),
+        ]
+
+    try:
+        asyncio.run(run())
+    finally:
+        engine._executor.shutdown()
+
+
+def test_chat_prompt_tokens_without_special_markers():
+    engine = InferenceEngine(Settings())
+    model = _FakeModel()
+    engine._state = (model, "test-plain")
+    engine.prompt_format = PromptFormat.PLAIN
+    template = prompt_manager.get_template(PromptFormat.PLAIN)
+
+    first = [{"role": "user", "content": "hi"}]
+    second = first + [
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "bye"},
+    ]
+
+    async def run():
+        for messages in (first, second, second):
+            tokens = await engine.chat_prompt_tokens(messages)
+            # No stray space tokens at message boundaries
+            assert tokens == [1] + _spm_tokenize(template.format_chat(messages))
+
+    try:
+        asyncio.run(run())
+    finally:
+        engine._executor.shutdown()